@@ -0,0 +1,241 @@
+''' Loopback MapleJuice benchmark: starts `--nodes` maplejuice.py processes on 127.0.0.1, each with
+its own ports (see cluster_config.py) and data directory under `--dir`, then runs word count
+(maple1.py / juice1.py) and the two-stage condorcet pipeline (condorcet/mj_*.py), once as two
+maple/juice jobs and once as a single `pipeline`, at every input size and reports jobs/sec,
+records/sec and phase times, taken from the master's `stats` timeline.
+
+    python3 benchmark.py --nodes 4 --sizes 10000,100000 --repeat 3 --out bench.json
+
+The nodes need the usual dependencies (requirements.txt, credentials.py) but no SSH, inputs and
+executables are placed in the master's directory. '''
+import os
+import re
+import sys
+import json
+import time
+import queue
+import random
+import shutil
+import argparse
+import threading
+import statistics
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# membership port of the first node, the others follow PORT_STEP apart
+BASE_PORT = 46000
+PORT_STEP = 10
+
+WORDCOUNT_EXES = ['maple1.py', 'juice1.py']
+CONDORCET_EXES = ['mj_maple_1.py', 'mj_juice_1.py', 'mj_maple_2.py', 'mj_juice_2.py']
+CONDORCET_CANDIDATES = 5
+
+class Node:
+    ''' One maplejuice.py process with its own ports and data directory '''
+    def __init__(self, index, nodes, bench_dir):
+        self.host = nodes[index]
+        self.dir = os.path.join(bench_dir, f"node{index}")
+        os.makedirs(self.dir)
+        env = dict(os.environ, MJ_NODE=self.host, MJ_DATA_DIR=self.dir, MJ_HOSTS=','.join(nodes), MJ_INTRODUCERS=nodes[0], MJ_PRIMARY=nodes[0])
+        self.proc = subprocess.Popen([sys.executable, '-u', os.path.join(HERE, 'maplejuice.py')], env=env,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+        self.lines = queue.Queue()
+        threading.Thread(target=self.reader, daemon=True).start()
+
+    def reader(self):
+        for line in self.proc.stdout:
+            self.lines.put(line)
+
+    def command(self, cmd):
+        self.proc.stdin.write(cmd + '\n')
+        self.proc.stdin.flush()
+
+    def expect(self, pattern, timeout):
+        ''' wait for an output line matching `pattern`, returns the match '''
+        deadline = time.time() + timeout
+        while True:
+            try:
+                line = self.lines.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                raise TimeoutError(f"{self.host}: no output matching {pattern!r} after {timeout}s")
+            match = re.search(pattern, line)
+            if match:
+                return match
+
+    def drain(self, seconds):
+        ''' output lines printed in the next `seconds` '''
+        lines = []
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            try:
+                lines.append(self.lines.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return lines
+
+    def stop(self):
+        self.proc.kill()
+        self.proc.wait()
+
+class LoopbackCluster:
+    ''' `num_nodes` nodes on 127.0.0.1, the first one is introducer and master '''
+    def __init__(self, num_nodes, bench_dir):
+        nodes = [f"127.0.0.1:{BASE_PORT + i * PORT_STEP}" for i in range(num_nodes)]
+        shutil.rmtree(bench_dir, ignore_errors=True)
+        self.nodes = [Node(i, nodes, bench_dir) for i in range(num_nodes)]
+        self.master = self.nodes[0]
+        self.numJobs = 0
+
+    def waitMembers(self, timeout):
+        ''' wait until the master's membership list has every node in it '''
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.master.command('print')
+            members = set(re.findall(r"127\.0\.0\.1:(\d+)\s+\d+\s+\d+\s+NORMAL", ''.join(self.master.drain(1))))
+            if len(members) >= len(self.nodes):
+                return
+        raise TimeoutError(f"only {len(members)}/{len(self.nodes)} nodes joined")
+
+    def place(self, path):
+        ''' copy a file into the master's working directory, returns its name there '''
+        name = os.path.basename(path)
+        shutil.copy(path, os.path.join(self.master.dir, name))
+        return name
+
+    def runJob(self, maple_exe, juice_exe, src, dest, num_workers, options, timeout):
+        ''' run one maple + juice job to completion, returns (job id, wall time) '''
+        prefix = f"bench{self.numJobs}"
+        self.numJobs += 1
+        start = time.time()
+        self.master.command(f"maple {maple_exe} {num_workers} {prefix} {src} {options}".rstrip())
+        job_id = self.master.expect(rf"job (\d+) submitted with prefix {prefix}\b", timeout).group(1)
+        self.master.command(f"juice {juice_exe} {num_workers} {prefix} {dest}")
+        self.master.expect(rf"Job {job_id} Done", timeout)
+        return int(job_id), time.time() - start
+
+    def runPipeline(self, stages, src, dest, num_workers, timeout):
+        ''' run a pipeline of `maple:juice[:combiner]` stages to completion, returns (job ids, wall time) '''
+        prefix = f"bench{self.numJobs}"
+        self.numJobs += 1
+        start = time.time()
+        self.master.command(f"pipeline {num_workers} {prefix} {src} {dest} {' '.join(stages)}")
+        match = self.master.expect(rf"pipeline jobs (\d+)-(\d+) submitted with prefix {prefix}\b", timeout)
+        job_ids = list(range(int(match.group(1)), int(match.group(2)) + 1))
+        self.master.expect(rf"Job {job_ids[-1]} Done", timeout)
+        return job_ids, time.time() - start
+
+    def stats(self, job_id, timeout):
+        ''' the job's timeline as written by the master's `stats` command '''
+        self.master.command(f"stats {job_id}")
+        path = self.master.expect(r"Timeline written to (\S+)", timeout).group(1)
+        with open(os.path.join(self.master.dir, path)) as f:
+            return json.load(f)
+
+    def stop(self):
+        for node in self.nodes:
+            node.stop()
+
+def genWordCount(path, num_lines, seed=0):
+    ''' `num_lines` lines of 10 words drawn from a Zipf-like 5000 word vocabulary '''
+    rng = random.Random(seed)
+    vocab = [f"w{i}" for i in range(5000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocab))]
+    with open(path, 'w') as f:
+        for _ in range(num_lines):
+            f.write(' '.join(rng.choices(vocab, weights, k=10)) + '\n')
+
+def genVotes(path, num_votes):
+    with open(path, 'w') as f:
+        subprocess.run([sys.executable, os.path.join(HERE, 'condorcet', 'gen_rand_input.py'), str(num_votes), str(CONDORCET_CANDIDATES)], stdout=f, check=True)
+
+def summarize(traces):
+    ''' phase times and maple records of the jobs of one run, from their Chrome traces '''
+    summary = {'maple_time': 0.0, 'juice_time': 0.0, 'maple_records': 0, 'input_bytes': 0}
+    for trace in traces:
+        for event in trace['traceEvents']:
+            if event['cat'] == 'phase':
+                summary[f"{event['name']}_time"] += event['dur'] / 1e6
+            elif event['cat'] == 'maple' and 'args' in event:
+                summary['maple_records'] += event['args']['output_records'] or 0
+                summary['input_bytes'] += event['args']['input_bytes'] or 0
+    return summary
+
+def runWordCount(cluster, size, workers, timeout):
+    src = f"wordcount_{size}.txt"
+    genWordCount(os.path.join(cluster.master.dir, src), size)
+    job_id, wall = cluster.runJob('maple1.py', 'juice1.py', src, f"wordcount_{size}_out.txt", workers, 'combiner=sum', timeout)
+    return wall, 1, [cluster.stats(job_id, timeout)]
+
+def runCondorcet(cluster, size, workers, timeout):
+    src = f"votes_{size}.txt"
+    genVotes(os.path.join(cluster.master.dir, src), size)
+    stage1 = f"condorcet_{size}_stage1.txt"
+    job1, wall1 = cluster.runJob('mj_maple_1.py', 'mj_juice_1.py', src, stage1, workers, 'combiner=sum', timeout)
+    job2, wall2 = cluster.runJob('mj_maple_2.py', 'mj_juice_2.py', stage1, f"condorcet_{size}_out.txt", workers, '', timeout)
+    return wall1 + wall2, 2, [cluster.stats(job1, timeout), cluster.stats(job2, timeout)]
+
+def runCondorcetPipeline(cluster, size, workers, timeout):
+    src = f"votes_{size}.txt"
+    genVotes(os.path.join(cluster.master.dir, src), size)
+    stages = ['mj_maple_1.py:mj_juice_1.py:sum', 'mj_maple_2.py:mj_juice_2.py']
+    job_ids, wall = cluster.runPipeline(stages, src, f"condorcet_{size}_out.txt", workers, timeout)
+    return wall, 1, [cluster.stats(job_id, timeout) for job_id in job_ids]
+
+WORKLOADS = {
+    'wordcount': runWordCount,
+    'condorcet': runCondorcet,
+    'pipeline': runCondorcetPipeline,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="MapleJuice benchmark on a loopback cluster")
+    parser.add_argument('--nodes', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=None, help="maple/juice workers per job, default all nodes")
+    parser.add_argument('--sizes', default='10000,100000', help="comma separated input sizes in lines (votes for condorcet)")
+    parser.add_argument('--workloads', default=','.join(WORKLOADS))
+    parser.add_argument('--repeat', type=int, default=1, help="runs per workload and size, the median is reported")
+    parser.add_argument('--timeout', type=float, default=600, help="seconds to wait for any single step")
+    parser.add_argument('--dir', default=os.path.join(HERE, 'bench'))
+    parser.add_argument('--out', default=None, help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    workers = args.workers or args.nodes
+    cluster = LoopbackCluster(args.nodes, args.dir)
+    results = []
+    try:
+        cluster.waitMembers(args.timeout)
+        for exe in WORDCOUNT_EXES:
+            cluster.place(os.path.join(HERE, exe))
+        for exe in CONDORCET_EXES:
+            cluster.place(os.path.join(HERE, 'condorcet', exe))
+
+        for workload in args.workloads.split(','):
+            for size in sizes:
+                runs = []
+                for _ in range(args.repeat):
+                    wall, num_jobs, traces = WORKLOADS[workload](cluster, size, workers, args.timeout)
+                    runs.append(dict(summarize(traces), wall=wall, jobs=num_jobs))
+                run = sorted(runs, key=lambda r: r['wall'])[len(runs) // 2]
+                results.append(dict(run, workload=workload, size=size, nodes=args.nodes, workers=workers,
+                                    jobs_per_sec=run['jobs'] / run['wall'], records_per_sec=size / run['wall'],
+                                    walls=[r['wall'] for r in runs]))
+    finally:
+        cluster.stop()
+
+    fmt = '{:<10} {:>9} {:>8} {:>9} {:>12} {:>9} {:>9} {:>12}'
+    print(fmt.format("Workload", "Size", "Wall", "Jobs/s", "Records/s", "Maple", "Juice", "Maple Recs"))
+    print(fmt.format("-" * 10, "-" * 9, "-" * 8, "-" * 9, "-" * 12, "-" * 9, "-" * 9, "-" * 12))
+    for r in results:
+        print(fmt.format(r['workload'], r['size'], f"{r['wall']:.2f}", f"{r['jobs_per_sec']:.3f}", f"{r['records_per_sec']:.0f}",
+                         f"{r['maple_time']:.2f}", f"{r['juice_time']:.2f}", r['maple_records']))
+    if len(results) and args.repeat > 1:
+        print(f"wall time spread (stdev over {args.repeat} runs): " + ', '.join(f"{r['workload']}/{r['size']} {statistics.pstdev(r['walls']):.2f}s" for r in results))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
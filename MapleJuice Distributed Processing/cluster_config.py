@@ -0,0 +1,114 @@
+''' Cluster configuration: this node's address, ports and data directory, and its peers.
+
+Settings are read from a JSON file (--config or MJ_CONFIG), then MJ_* environment variables,
+then command line flags of maplejuice.py / sdfs.py, each overriding the previous:
+
+    {
+        "nodes": [
+            {"host": "127.0.0.1", "port": 46000, "data_dir": "nodes/1"},
+            {"host": "127.0.0.1", "port": 46010, "data_dir": "nodes/2", "slots": 2},
+            "fa20-cs425-g22-03.cs.illinois.edu"
+        ],
+        "introducers": ["127.0.0.1:46000"],
+        "primary": "127.0.0.1:46000",
+        "backups": ["127.0.0.1:46010"]
+    }
+
+    python3 maplejuice.py --config cluster.json --node 127.0.0.1:46010
+
+A node is identified by `host:port`, `port` being its membership port, or by `host` alone when
+it uses the default one. Its other servers listen on the ports below that one, at the same
+offsets as the defaults in constants.py '''
+import os
+import sys
+import json
+import argparse
+
+# setting -> environment variable
+ENVIRONMENT = {
+    'node': 'MJ_NODE',
+    'host': 'MJ_HOST',
+    'port': 'MJ_PORT',
+    'data_dir': 'MJ_DATA_DIR',
+    'slots': 'MJ_SLOTS',
+    'nodes': 'MJ_HOSTS',
+    'introducers': 'MJ_INTRODUCERS',
+    'primary': 'MJ_PRIMARY',
+    'backups': 'MJ_BACKUPS',
+}
+# settings given as comma separated node lists in the environment and on the command line
+NODE_LISTS = ('nodes', 'introducers', 'backups')
+
+def nodeName(host, port, default_port):
+    ''' node id of the node with membership port `port` (None for the default) at `host` '''
+    return host if port in (None, default_port) else f"{host}:{port}"
+
+def normalizeNode(node, default_port):
+    ''' node id of a `host[:port]` string or a {"host", "port"} config entry '''
+    if isinstance(node, dict):
+        return nodeName(node['host'], node.get('port'), default_port)
+    host, _, port = node.partition(':')
+    return nodeName(host, int(port) if port else None, default_port)
+
+def parseFlags(argv):
+    ''' cluster flags from the command line, anything else is left to the caller '''
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--config')
+    parser.add_argument('--node', help="this node's id (host or host:port) in the config file")
+    parser.add_argument('--host', help="this node's address")
+    parser.add_argument('--port', type=int, help="this node's membership port")
+    parser.add_argument('--data-dir', dest='data_dir')
+    parser.add_argument('--slots', type=int, help="maple/juice tasks this node runs at once")
+    parser.add_argument('--peers', dest='nodes', help="comma separated ids of all nodes")
+    parser.add_argument('--introducers')
+    parser.add_argument('--primary')
+    parser.add_argument('--backups')
+    flags, _ = parser.parse_known_args(argv)
+    return {key: value for key, value in vars(flags).items() if value is not None}
+
+def loadClusterConfig(default_port, argv=None, environ=None):
+    ''' Merged cluster settings as a dict with keys `node`, `host`, `port`, `data_dir`, `slots`,
+    `nodes`, `data_dirs` (node id -> data directory), `introducers`, `primary` and `backups`,
+    every node given by its id. Settings that are not configured anywhere are None '''
+    argv = sys.argv[1:] if argv is None else argv
+    environ = os.environ if environ is None else environ
+    flags = parseFlags(argv)
+
+    settings = dict.fromkeys(ENVIRONMENT)
+    path = flags.pop('config', None) or environ.get('MJ_CONFIG')
+    if path:
+        with open(path) as f:
+            settings.update(json.load(f))
+    for key, var in ENVIRONMENT.items():
+        if environ.get(var):
+            settings[key] = environ[var]
+    settings.update(flags)
+
+    for key in NODE_LISTS:
+        if isinstance(settings[key], str):
+            settings[key] = settings[key].split(',')
+
+    # data directories of the nodes listed with one, so files can be copied from their SDFS
+    settings['data_dirs'] = {normalizeNode(node, default_port): node['data_dir']
+                             for node in settings['nodes'] or [] if isinstance(node, dict) and 'data_dir' in node}
+    slots = {normalizeNode(node, default_port): node['slots']
+             for node in settings['nodes'] or [] if isinstance(node, dict) and 'slots' in node}
+    for key in NODE_LISTS:
+        if settings[key] is not None:
+            settings[key] = [normalizeNode(node, default_port) for node in settings[key]]
+    if settings['primary'] is not None:
+        settings['primary'] = normalizeNode(settings['primary'], default_port)
+    if settings['port'] is not None:
+        settings['port'] = int(settings['port'])
+
+    # --node picks this node's address, port, data directory and slots out of the config
+    if settings['node'] is not None:
+        settings['node'] = normalizeNode(settings['node'], default_port)
+        host, _, port = settings['node'].partition(':')
+        settings['host'] = settings['host'] or host
+        settings['port'] = settings['port'] or (int(port) if port else None)
+        settings['data_dir'] = settings['data_dir'] or settings['data_dirs'].get(settings['node'])
+        settings['slots'] = settings['slots'] or slots.get(settings['node'])
+    if settings['slots'] is not None:
+        settings['slots'] = int(settings['slots'])
+    return settings
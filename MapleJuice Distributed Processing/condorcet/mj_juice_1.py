@@ -0,0 +1,15 @@
+# Juice (MapleJuice): key `Ca,Cb` as argv[1], its +-1 values on stdin --> `Ca:doms,Cb:doms`
+import sys
+
+def main():
+  Ca, Cb = sys.argv[1].split(',')
+  net_doms = sum(int(line) for line in sys.stdin if line.strip())
+  if net_doms > 0:
+    print(f'{Ca}:1,{Cb}:0')
+  elif net_doms < 0:
+    print(f'{Ca}:0,{Cb}:1')
+  else:
+    print(f'{Ca}:0,{Cb}:0')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,14 @@
+# Juice (MapleJuice): `C:doms` values on stdin --> the comma-separated Condorcet winner(s)
+import sys
+
+def main():
+  scores = {}
+  for line in sys.stdin:
+    if line.strip():
+      Ca, k = line.strip().split(':')
+      scores[Ca] = scores.get(Ca, 0) + int(k)
+  most_doms = max(scores.values())
+  print(','.join(Ca for Ca, num_doms in scores.items() if num_doms == most_doms))
+
+if __name__ == '__main__':
+  main()
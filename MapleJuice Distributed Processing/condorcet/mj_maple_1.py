@@ -0,0 +1,20 @@
+# Maple (MapleJuice): one tab-separated ranking per line on stdin --> `Ci,Cj +-1` per candidate pair
+import sys
+from typing import List
+
+def main():
+  for line in sys.stdin:
+    vote = line.strip().split('\t')
+    if vote != ['']:
+      maple(vote)
+
+def maple(vote: List[str]):
+  for i, Vi in enumerate(vote[:-1]):
+    for Vj in vote[i+1:]:
+      if Vi < Vj:
+        print(f'{Vi},{Vj} 1')
+      else:
+        print(f'{Vj},{Vi} -1')
+
+if __name__ == '__main__':
+  main()
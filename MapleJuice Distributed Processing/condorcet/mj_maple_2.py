@@ -0,0 +1,12 @@
+# Maple (MapleJuice): `Ca,Cb Ca:doms,Cb:doms` lines of stage 1 --> `1 C:doms` per candidate
+import sys
+
+def main():
+  for line in sys.stdin:
+    fields = line.split()
+    if len(fields) == 2:
+      for score in fields[1].split(','):
+        print(f'1 {score}')
+
+if __name__ == '__main__':
+  main()
@@ -1,10 +1,44 @@
+import os
+import socket
+
+from cluster_config import loadClusterConfig, nodeName
+
 DEFAULT_PORT_MEMBERSHIP = 45299
 DEFAULT_PORT_SDFS_NAMENODE = 45298
 DEFAULT_PORT_SDFS_DATANODE = 45297
 DEFAULT_PORT_MJ_NAMENODE = 45296
 DEFAULT_PORT_MJ_DATANODE = 45295
+# TCP ports of the MapleJuice bulk channel (task payloads and results)
+DEFAULT_PORT_MJ_NAMENODE_BULK = 45294
+DEFAULT_PORT_MJ_DATANODE_BULK = 45293
+
+# Every node uses these ports shifted by the difference between its membership port and
+# DEFAULT_PORT_MEMBERSHIP, so nodes sharing an address need membership ports at least 7 apart
+CLUSTER = loadClusterConfig(DEFAULT_PORT_MEMBERSHIP)
+
+def nodeAddr(node, port=DEFAULT_PORT_MEMBERSHIP):
+    ''' (address, port) of the server with default port `port` on the node with id `node` '''
+    host, _, base = node.partition(':')
+    return (host, port + int(base or DEFAULT_PORT_MEMBERSHIP) - DEFAULT_PORT_MEMBERSHIP)
+
+def nodeId(addr, port=DEFAULT_PORT_MEMBERSHIP):
+    ''' inverse of nodeAddr: id of the node whose server with default port `port` is at `addr` '''
+    return nodeName(addr[0], addr[1] - port + DEFAULT_PORT_MEMBERSHIP, DEFAULT_PORT_MEMBERSHIP)
+
+def nodeHost(node):
+    ''' address of the node with id `node`, for SSH '''
+    return node.partition(':')[0]
+
+# This node's id (see cluster_config.py) and the directory it keeps its files in, relative
+# file names in commands are looked up there too
+NODE_ID = nodeName(CLUSTER['host'] or socket.gethostname(), CLUSTER['port'], DEFAULT_PORT_MEMBERSHIP)
+DATA_DIR = CLUSTER['data_dir'] or CLUSTER['data_dirs'].get(NODE_ID) or '.'
 
-ALL_HOST_NAMES = [
+def nodeDataDir(node):
+    ''' data directory of another node, as configured, else assumed to be the same as ours '''
+    return CLUSTER['data_dirs'].get(node, DATA_DIR)
+
+ALL_HOST_NAMES = CLUSTER['nodes'] or [
     'fa20-cs425-g22-01.cs.illinois.edu',
     'fa20-cs425-g22-02.cs.illinois.edu',
     'fa20-cs425-g22-03.cs.illinois.edu',
@@ -17,27 +51,88 @@ ALL_HOST_NAMES = [
     'fa20-cs425-g22-10.cs.illinois.edu'
 ]
 
-INTRODUCER_HOST_NAMES = [
+INTRODUCER_HOST_NAMES = CLUSTER['introducers'] or [
     'fa20-cs425-g22-02.cs.illinois.edu',
     'fa20-cs425-g22-04.cs.illinois.edu',
     'fa20-cs425-g22-06.cs.illinois.edu',
     'fa20-cs425-g22-08.cs.illinois.edu',
 ]
 
-DEFAULT_PRIMARY_NAMENODE_HOST = 'fa20-cs425-g22-01.cs.illinois.edu'
+DEFAULT_PRIMARY_NAMENODE_HOST = CLUSTER['primary'] or 'fa20-cs425-g22-01.cs.illinois.edu'
 
-DEFAULT_BACKUP_NAMENODE_HOSTS = [
+DEFAULT_BACKUP_NAMENODE_HOSTS = CLUSTER['backups'] or [
     'fa20-cs425-g22-02.cs.illinois.edu',
     'fa20-cs425-g22-04.cs.illinois.edu',
     'fa20-cs425-g22-06.cs.illinois.edu',
     'fa20-cs425-g22-08.cs.illinois.edu',
 ]
 
+# SCP transfers share at most SSH_POOL_SIZE open SSH sessions per process, kept alive
+# with a keepalive packet every SSH_KEEPALIVE seconds
+SSH_POOL_SIZE = 8
+SSH_KEEPALIVE = 30
+# pause between retries of a failed SCP transfer
+SSH_RETRY_DELAY = 0.5
+
 # change username for demo
 # USER_NAME = ""
 # PASSWORD = ""
 
+# The MapleJuice scheduler is woken up by job/task events, this is only a fallback period (seconds)
+MJ_SCHEDULER_TIMEOUT = 1
+# Number of finished jobs the master keeps around for `stats`
+MJ_JOB_HISTORY = 20
+# Maple/juice tasks this node runs at once, advertised to the master which only sends a worker
+# a task when one of its slots is free. The master assumes its own count for a worker it hasn't
+# heard from yet
+MJ_WORKER_SLOTS = CLUSTER['slots'] or os.cpu_count()
+# Worker process pools a node keeps for its most recently used executables, older idle ones
+# are closed
+MJ_WORKER_POOLS = 4
+# A task whose attempts failed on their workers this many times fails its job, e.g. a maple
+# executable that raises on its input would otherwise be re-run forever
+MJ_TASK_MAX_FAILURES = 4
+
 SDFS_PATH = "SDFS"
 TMP_PATH = "tmp"
+# maple/juice executables stored by content hash, kept across jobs and restarts
+EXE_CACHE_PATH = "exe_cache"
+
+# Maple task sizing: an input is cut into about MAPLE_TASKS_PER_WORKER splits per
+# worker, but a split is never larger than MAPLE_SPLIT_SIZE nor smaller than
+# MAPLE_MIN_SPLIT_SIZE bytes. Split boundaries are moved forward to the next newline.
+MAPLE_SPLIT_SIZE = 16 * 1024 * 1024
+MAPLE_MIN_SPLIT_SIZE = 64 * 1024
+MAPLE_TASKS_PER_WORKER = 4
+
+# A maple executable's output is read from its worker in chunks of about MAPLE_CHUNK_BYTES
+# while it runs, and spilled to sorted runs on disk every MAPLE_SPILL_BYTES of it
+MAPLE_CHUNK_BYTES = 1024 * 1024
+MAPLE_SPILL_BYTES = 32 * 1024 * 1024
+
+# Number of hash partitions each maple task splits its output into, juice tasks
+# are made of groups of these partitions (hash) or of sampled key ranges (range)
+MAPLE_NUM_PARTITIONS = 16
+# Number of keys each maple task samples from its output for range partitioning
+MAPLE_KEY_SAMPLE_SIZE = 100
+# Intermediate key/value records are written in blocks of about KV_BLOCK_SIZE bytes,
+# the unit of (optional) compression
+KV_BLOCK_SIZE = 64 * 1024
+# A maple worker streams the partitions a juice task pulls in frames of about FETCH_FRAME_BYTES,
+# which the juice task writes to its run file as they arrive
+FETCH_FRAME_BYTES = 1024 * 1024
+
+# Speculative execution: once MJ_SPECULATIVE_MIN_DONE of a phase's tasks are done, a task
+# running longer than MJ_SPECULATIVE_MULTIPLIER times their median runtime (and at least
+# MJ_SPECULATIVE_MIN_RUNTIME seconds) gets a backup attempt on another worker
+MJ_SPECULATIVE_MULTIPLIER = 2.0
+MJ_SPECULATIVE_MIN_DONE = 0.5
+MJ_SPECULATIVE_MIN_RUNTIME = 1
 
-MAPLE_BLOCK_SIZE = 6
+# A juice task sends its keys to the reducer process in batches of up to JUICE_BATCH_KEYS
+# keys or JUICE_BATCH_BYTES bytes of values, one round trip per batch
+JUICE_BATCH_KEYS = 4096
+JUICE_BATCH_BYTES = 4 * 1024 * 1024
+# The master merges sharded juice output by reading each shard from its worker in requests
+# of up to JUICE_MERGE_CHUNK_BYTES
+JUICE_MERGE_CHUNK_BYTES = 16 * 1024 * 1024
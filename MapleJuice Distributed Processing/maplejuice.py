@@ -8,10 +8,23 @@ from sdfs_namenode import NameNodeServer as SDFS_NameNodeServer
 from sdfs_datanode import DataNodeServer as SDFS_DataNodeServer
 from membership import MembershipServer
 from message import MessageType
+from constants import DATA_DIR
+from maplejuice_utils import Job
 
 from maplejuice_namenode import NameNodeServer as maplejuice_NameNodeServer
 from maplejuice_datanode import DataNodeServer as maplejuice_DataNodeServer
 
+def parseOptions(args, allowed=Job.OPTIONS):
+    ''' Parse optional trailing `key=value` command arguments into a dict '''
+    options = {}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if key in allowed and value:
+            options[key] = value
+        else:
+            print('[ERROR] Ignoring invalid option %s' % arg)
+    return options
+
 class MapleJuice:
     def __init__(self):
         self.membershipList = MembershipServer()
@@ -55,23 +68,51 @@ class MapleJuice:
             elif arg == 'join':
                 self.membershipList.join()
 
-            elif args[0] == 'maple' and len(args) == 5:
+            # maple `maple_exe` `num_maples` `sdfs_prefix` `sdfs_src` [combiner={sum,count,min,max,<exe>}]
+            #       [split_bytes=<max bytes per task>] [tasks_per_worker=<tasks per worker>] [partitions=<n>]
+            #       [speculation=<multiple>] [compress={0,1}] [mode={script,function}]
+            elif args[0] == 'maple' and len(args) >= 5:
                 mj_exe = args[1]
                 num_workers = args[2]
                 sdfs_prefix = args[3]
                 sdfs_location = args[4]
-                self.maplejuice_nameNode.handleClientRequest(MessageType.MAPLE, mj_exe, num_workers, sdfs_prefix, sdfs_location)
+                options = parseOptions(args[5:])
+                self.maplejuice_nameNode.handleClientRequest(MessageType.MAPLE, mj_exe, num_workers, sdfs_prefix, sdfs_location, **options)
                 pass
 
-            elif args[0] == 'juice' and len(args) == 5:
+            # juice `juice_exe` `num_juices` `sdfs_prefix` `sdfs_dest` [partitioner={hash,range}] [shards={0,1}] [merge={0,1}]
+            elif args[0] == 'juice' and len(args) >= 5:
                 mj_exe = args[1]
                 num_workers = args[2]
                 sdfs_prefix = args[3]
                 sdfs_location = args[4]
                 # delete_input = args[5]
-                self.maplejuice_nameNode.handleClientRequest(MessageType.JUICE, mj_exe, num_workers, sdfs_prefix, sdfs_location)
+                options = parseOptions(args[5:])
+                self.maplejuice_nameNode.handleClientRequest(MessageType.JUICE, mj_exe, num_workers, sdfs_prefix, sdfs_location, **options)
                 pass
             
+            # pipeline `num_workers` `sdfs_prefix` `sdfs_src` `sdfs_dest` `maple_exe`:`juice_exe`[:`combiner`] ...
+            #       [maple options] : stages run as one job each, every stage reading the previous one's
+            #       output on the workers, only the last one's is written to `sdfs_dest`
+            elif args[0] == 'pipeline' and len(args) >= 6:
+                num_workers = args[1]
+                sdfs_prefix = args[2]
+                sdfs_src = args[3]
+                sdfs_dest = args[4]
+                stages = [(stage.split(':') + [None])[:3] for stage in args[5:] if '=' not in stage]
+                options = parseOptions([option for option in args[5:] if '=' in option])
+                if all(maple_exe and juice_exe for maple_exe, juice_exe, _ in stages):
+                    self.maplejuice_nameNode.handlePipelineRequest(stages, num_workers, sdfs_prefix, sdfs_src, sdfs_dest, **options)
+                else:
+                    print('[ERROR] Invalid pipeline stage in %s' % arg)
+
+            elif arg == 'jobs':
+                self.maplejuice_nameNode.printJobs()
+
+            # stats `job_id`: per-task timeline, also written as a Chrome trace
+            elif args[0] == 'stats' and len(args) == 2 and args[1].isdigit():
+                self.maplejuice_nameNode.printStats(int(args[1]))
+
             else:
                 print('[ERROR] Invalid input argument %s' % arg)
 
@@ -85,5 +126,8 @@ class MapleJuice:
         self.listener()
 
 if __name__ == '__main__':
+    # every node works in its own data directory, see cluster_config.py
+    os.makedirs(DATA_DIR, exist_ok=True)
+    os.chdir(DATA_DIR)
     s = MapleJuice()
     s.run()
@@ -1,14 +1,19 @@
 import os
+import heapq
+import contextlib
+from operator import itemgetter
 import json
 import shutil
 import time
 import socket
 import subprocess
 import threading
-from paramiko import SSHClient, AutoAddPolicy
-from scp import SCPClient
-from collections import defaultdict
+import traceback
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from logger import Logger
+from maplejuice_worker import WorkerPool, FunctionPool
+from maplejuice_transport import BulkChannel, BulkServer
 
 from sdfs_utils import (
     SDFSFile,
@@ -17,6 +22,26 @@ from sdfs_utils import (
 )
 
 from maplejuice_utils import (
+    COMBINERS,
+    COMBINER_MERGES,
+    exeCachePath,
+    exeDigest,
+    keyRangeOf,
+    jobFiles,
+    mergeRuns,
+    parseLines,
+    partitionOf,
+    readRecords,
+    writeRecords,
+    recordBlocks,
+    runFile,
+    serveFetch,
+    shuffleFile,
+    spillFile,
+    sampleKeys,
+    stageFile,
+    readLines,
+    readSplit,
     Job,
     JobStatus,
     Task,
@@ -26,14 +51,22 @@ from maplejuice_utils import (
 )
 
 from constants import (
+    NODE_ID,
     DEFAULT_PORT_MJ_DATANODE,
+    DEFAULT_PORT_MJ_NAMENODE_BULK,
+    DEFAULT_PORT_MJ_DATANODE_BULK,
+    MAPLE_KEY_SAMPLE_SIZE,
+    MAPLE_CHUNK_BYTES,
+    MAPLE_SPILL_BYTES,
+    FETCH_FRAME_BYTES,
+    JUICE_BATCH_KEYS,
+    JUICE_BATCH_BYTES,
+    MJ_WORKER_SLOTS,
+    MJ_WORKER_POOLS,
     SDFS_PATH,
     TMP_PATH,
-)
-
-from credentials import (
-    USERNAME,
-    PASSWORD,
+    EXE_CACHE_PATH,
+    nodeAddr,
 )
 
 from message import (
@@ -45,155 +78,441 @@ DEBUG = False
 
 class DataNodeServer:
     def __init__(self):
-        self.host = socket.gethostname()
-        self.addr = (self.host, DEFAULT_PORT_MJ_DATANODE)
+        self.host = NODE_ID
+        self.addr = nodeAddr(self.host, DEFAULT_PORT_MJ_DATANODE)
+        self.bulkAddr = nodeAddr(self.host, DEFAULT_PORT_MJ_DATANODE_BULK)
+        self.bulk = BulkChannel()
         self.logger = Logger(name="MJDataNodeServer").logger
 
+        # tasks run in at most MJ_WORKER_SLOTS threads, the master doesn't send more than that
+        # anyway, a task sent beyond it (e.g. after a master failover) waits for a slot here
+        self.slots = MJ_WORKER_SLOTS
+        self.executor = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix="MJTask")
+
+        # persistent worker processes, one pool per cached executable and execution mode as
+        # (exe, mode) -> [pool, tasks using it], least recently used first
+        self.pools = OrderedDict()
+        self.poolLock = threading.Lock()
+        # digest -> lock held while that executable is being fetched
+        self.exeLocks = {}
+        self.exeLock = threading.Lock()
+
+    @contextlib.contextmanager
+    def usePool(self, exe, mode=None):
+        ''' WorkerPool running `exe` as a script, or FunctionPool with it imported in function mode,
+        for the duration of the `with` block '''
+        with self.poolLock:
+            entry = self.pools.pop((exe, mode), None)
+            if entry is None:
+                entry = [FunctionPool(exe) if mode == 'function' else WorkerPool(exe), 0]
+            self.pools[(exe, mode)] = entry
+            entry[1] += 1
+            self.evictPools()
+        try:
+            yield entry[0]
+        finally:
+            with self.poolLock:
+                entry[1] -= 1
+                self.evictPools()
+
+    def evictPools(self):
+        ''' Close the least recently used pools no task is using beyond MJ_WORKER_POOLS, every edited
+        executable being a new pool (called with poolLock held) '''
+        for key in list(self.pools):
+            if len(self.pools) <= MJ_WORKER_POOLS:
+                break
+            pool, users = self.pools[key]
+            if users == 0:
+                del self.pools[key]
+                pool.close()
+
+    def ensureExe(self, message, exe):
+        ''' Path of `exe` in the local executable cache, fetched from the master only on a miss.
+        The cache is keyed by content, so a changed executable is a new entry and gets a new pool '''
+        digest = message['exes'][exe]
+        path = exeCachePath(digest)
+        # a cache hit doesn't wait for other executables being fetched
+        if os.path.isfile(path):
+            return path
+        with self.exeLock:
+            lock = self.exeLocks.setdefault(digest, threading.Lock())
+        with lock:
+            if os.path.isfile(path):
+                return path
+            data = self.fetch(message['from_node'], path)
+            if exeDigest(data) != digest:
+                print(f"[ERROR-DataNode-ensureExe] [{exe}] fetched from {message['from_node']} doesn't match {digest}")
+                return None
+            os.makedirs(EXE_CACHE_PATH, exist_ok=True)
+            with open(path + '.part', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.part', path)
+        print(f"[INFO-DataNode-ensureExe] [{exe}] cached as [{path}] of size [{len(data)}]")
+        return path
+
     def handleJob(self, message):
-        ''' Receives a job and get the mj_exe to local directory '''
-        mj_exe = message['mj_exe']
+        ''' Receives a job and makes sure its executables are in the local cache '''
         from_vm = message['from_vm']
 
         if DEBUG:
-            print(f"[DEBUG-MJDataNode-handleJob] {from_vm} {mj_exe}")
-
-        # Get mj_exe from master
-        ssh = SSHClient()
-        ssh.load_system_host_keys()
-        # ssh.set_missing_host_key_policy(AutoAddPolicy())
-        ssh.connect(hostname = from_vm[0],
-                    username = USERNAME,
-                    password = PASSWORD)
-
-        mj_exe_path = os.path.join(TMP_PATH, mj_exe)
-        remote_path = os.path.join('mp3', mj_exe_path)
-        while mj_exe not in os.listdir(TMP_PATH):
-            time.sleep(1)
-            try:
-                with SCPClient(ssh.get_transport()) as scp:
-                    scp.get(remote_path, mj_exe_path)
-            except Exception as e:
-                print(e)
-                stdin, stdout, stderr=ssh.exec_command("ls")
-                print(stdout.readlines())
-                print(stderr.readlines())
-                pass
-
-        filename_size = os.path.getsize(mj_exe_path)
-        print(f"[INFO-DataNode-handleJob] [{mj_exe}] successfully saved as [{mj_exe_path}] of size [{filename_size}]")
-
+            print(f"[DEBUG-MJDataNode-handleJob] {from_vm} {message['exes']}")
+
+        # the master drops a worker that can't get the executables from the job, or fails the job
+        try:
+            for exe in message['exes']:
+                if self.ensureExe(message, exe) is None:
+                    raise FileNotFoundError(f"[{exe}] from {message['from_node']} doesn't match its digest")
+        except OSError as e:
+            print(f"[ERROR-DataNode-handleJob] job {message['job_id']}: {e}")
+            message['status'] = JobStatus.Failed
+            message['error'] = str(e)
+            self.sendAcknowledgement(message, MessageType.JOB_ACK)
+            return ErrorCode.FileNotFound
+
+        # advertise how many tasks this node runs at once
+        message['slots'] = self.slots
         self.sendAcknowledgement(message, MessageType.JOB_ACK)
         return ErrorCode.Normal
 
+    def handleJobCleanup(self, message):
+        ''' Deletes the intermediate files of a job that is over, a pipeline stage's output is kept
+        if `keep_output` is set since the next stage still reads it '''
+        removed = 0
+        for path in jobFiles(message['sdfs_prefix'], message['job_id']):
+            if message.get('keep_output') and '#o' in os.path.basename(path):
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        if DEBUG:
+            print(f"[DEBUG-MJDataNode-handleJobCleanup] job {message['job_id']}: {removed} files removed")
+
     def handleMapleTask(self, message):
         ''' Receives maple task and perform calculations on data '''
         print(f'[DEBUG-DataNode-handleMapleTask]')
-        mj_exe = message['mj_exe']
-        if mj_exe not in os.listdir('.'):
-            if DEBUG:
-                print(f"[DEBUG-DataNode-handleMapleTask] {mj_exe} does not exist in handleMapleTask()")
-            return
-
-        data = ''.join(message['data'])
-        message['data'] = []
-
-        # subprocess
-        with subprocess.Popen(["python3", mj_exe], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as proc:
-            output = proc.communicate(input=data.encode())[0]
-            output = output.decode()
-            message['kvpairs'] = defaultdict(list)
-
-            for line in output.rstrip('\n').split('\n'):
-                if line:
-                    k = line.split(' ')[0]
-                    v = line.split(' ')[1]
-                    message['kvpairs'][k].append(v)
+        message['task_start'] = time.time()
+        mj_exe = self.ensureExe(message, message['mj_exe'])
+        if mj_exe is None:
+            raise FileNotFoundError(f"executable {message['mj_exe']} not available")
+
+        data = self.fetchSplit(message)
+        split = message['data']
+        mode = split.get('mode')
+        combiner = message.get('combiner')
+        if combiner and combiner not in COMBINERS:
+            combiner = self.ensureExe(message, combiner)
+
+        # keys and values stay bytes from the executable's output to the partition files. The
+        # output is parsed chunk by chunk while the executable is still printing it, and every
+        # MAPLE_SPILL_BYTES of it is combined and spilled as sorted runs, one per partition
+        task = (message['sdfs_prefix'], message['job_id'], message['tid'])
+        num_spills = 0
+        records = [0] * split['partitions']
+        # a few keys for the master to cut key ranges from if juice is range partitioned
+        sample, num_keys = [], 0
+        kvpairs, size = defaultdict(list), 0
+        with self.usePool(mj_exe, mode) as pool:
+            if mode == 'function':
+                chunks = pool.maple(data, MAPLE_CHUNK_BYTES)
+            else:
+                chunks = ((parseLines(chunk), len(chunk)) for chunk in pool.stream(data, MAPLE_CHUNK_BYTES))
+            for chunk, chunk_size in chunks:
+                for k, values in chunk.items():
+                    kvpairs[k].extend(values)
+                size += chunk_size
+                if size >= MAPLE_SPILL_BYTES:
+                    num_keys = sampleKeys(sample, num_keys, kvpairs, MAPLE_KEY_SAMPLE_SIZE)
+                    self.spillPartitions(*task, num_spills, records, self.combine(kvpairs, combiner, mode) if combiner else kvpairs, split.get('compress'))
+                    num_spills += 1
+                    kvpairs, size = defaultdict(list), 0
+        if kvpairs:
+            num_keys = sampleKeys(sample, num_keys, kvpairs, MAPLE_KEY_SAMPLE_SIZE)
+            self.spillPartitions(*task, num_spills, records, self.combine(kvpairs, combiner, mode) if combiner else kvpairs, split.get('compress'))
+            num_spills += 1
+
+        # keep the output here, partitioned for the juice workers to pull
+        message['partition_sizes'] = self.mergeSpills(*task, num_spills, records, combiner, split.get('compress'))
+        message['output_records'] = sum(records)
+        message['key_sample'] = [k.decode() for k in sample]
+        message['input_bytes'] = len(data)
+        message['task_finish'] = time.time()
 
         message['status'] = TaskStatus.PendingUpload
         self.sendAcknowledgement(message, MessageType.TASK_ACK)
 
-    def handleJuiceTask(self, message):
-        ''' Receives juice task and perform calculations on data '''
-        ''' Receives maple task and perform calculations on data '''
-        mj_exe = message['mj_exe']
-        from_vm = message['from_vm']
-        if mj_exe not in os.listdir(TMP_PATH):
-            if DEBUG:
-                print(f"[DEBUG-DataNode-handleJuiceTask] {mj_exe} does not exist in handleMapleTask()")
-            
-            # Get mj_exe from master
-            ssh = SSHClient()
-            ssh.load_system_host_keys()
-            # ssh.set_missing_host_key_policy(AutoAddPolicy())
-            ssh.connect(hostname = from_vm[0],
-                        username = USERNAME,
-                        password = PASSWORD)
-
-            mj_exe_path = os.path.join(TMP_PATH, mj_exe)
-            remote_path = os.path.join('mp3', mj_exe_path)
-            while mj_exe not in os.listdir(TMP_PATH):
-                time.sleep(1)
-                try:
-                    with SCPClient(ssh.get_transport()) as scp:
-                        scp.get(remote_path, mj_exe_path)
-                except Exception as e:
-                    print(e)
-                    stdin, stdout, stderr=ssh.exec_command("ls")
-                    print(stdout.readlines())
-                    print(stderr.readlines())
-                    pass
-
-            filename_size = os.path.getsize(mj_exe_path)
-            print(f"[INFO-DataNode-handleJuiceTask] [{mj_exe}] successfully saved as [{mj_exe_path}] of size [{filename_size}]")
-
-        juice_file = message['data']
-
-        # Get mj_exe from master
-        ssh = SSHClient()
-        ssh.load_system_host_keys()
-        # ssh.set_missing_host_key_policy(AutoAddPolicy())
-        ssh.connect(hostname = from_vm[0],
-                    username = USERNAME,
-                    password = PASSWORD)
-
-        juice_file_path = os.path.join(TMP_PATH, juice_file)
-        remote_path = os.path.join('mp3', juice_file_path)
-        while juice_file not in os.listdir(TMP_PATH):
+    def spillPartitions(self, sdfs_prefix, job_id, tid, spill, records, kvpairs, compress=False):
+        ''' Hash-partition part of the output of maple task `tid` into local spill files, each one
+        a run of binary records sorted by key. `records` holds the record count of each partition
+        and is updated '''
+        partitions = defaultdict(list)
+        for k in sorted(kvpairs):
+            partition = partitionOf(k, len(records))
+            partitions[partition].extend((k, v) for v in kvpairs[k])
+
+        for partition, run in partitions.items():
+            with open(spillFile(sdfs_prefix, job_id, tid, partition, spill), 'wb') as f:
+                writeRecords(f, run, compress)
+            records[partition] += len(run)
+
+    def mergeSpills(self, sdfs_prefix, job_id, tid, num_spills, records, combiner=None, compress=False):
+        ''' Merge the spilled runs of each partition of maple task `tid` into its shuffle file, a
+        single run being just renamed. The values of a key spilled more than once are folded again
+        if the combiner is a built-in one, recounting `records`. Returns the number of bytes
+        written to each partition '''
+        sizes = [0] * len(records)
+        for partition in range(len(records)):
+            paths = [spillFile(sdfs_prefix, job_id, tid, partition, spill) for spill in range(num_spills)]
+            paths = [path for path in paths if os.path.isfile(path)]
+            path = shuffleFile(sdfs_prefix, job_id, tid, partition)
+            if len(paths) == 1:
+                os.replace(paths[0], path)
+                sizes[partition] = os.path.getsize(path)
+                continue
+            if not paths:
+                continue
+
+            with contextlib.ExitStack() as stack:
+                runs = [readRecords(stack.enter_context(open(spill_path, 'rb'))) for spill_path in paths]
+                if combiner in COMBINERS:
+                    records[partition] = 0
+                    merged = self.foldRuns(runs, COMBINER_MERGES[combiner], records, partition)
+                else:
+                    merged = heapq.merge(*runs, key=itemgetter(0))
+                with open(path, 'wb') as f:
+                    sizes[partition] = writeRecords(f, merged, compress)
+            for spill_path in paths:
+                os.remove(spill_path)
+        return sizes
+
+    def foldRuns(self, runs, fold, records, partition):
+        ''' Merge sorted runs, folding each key's values with a built-in combiner '''
+        for k, values in mergeRuns(runs):
+            for v in fold(values):
+                records[partition] += 1
+                yield k, v
+
+    def servePartition(self, msg):
+        ''' Answer a FETCH_PARTITION request with the given partitions of the given maple tasks'
+        output merged into one sorted run, keeping only the keys in `key_range` if one is set.
+        The run is yielded as reply frames of about FETCH_FRAME_BYTES as the merge produces it,
+        every one but the last with `more` set '''
+        reply = {'type': MessageType.FETCH_REPLY, 'status': ErrorCode.Normal, 'more': True}
+        key_range = msg.get('key_range')
+        paths = [shuffleFile(msg['sdfs_prefix'], msg['job_id'], tid, partition) for tid, partitions in msg['outputs'] for partition in partitions]
+        if not all(os.path.isfile(path) for path in paths):
+            yield dict(reply, status=ErrorCode.FileNotFound, more=False), b''
+            return
+
+        with contextlib.ExitStack() as stack:
+            runs = [readRecords(stack.enter_context(open(path, 'rb'))) for path in paths]
+            # every run is sorted, each one is cut to the range before the merge rather than after it
+            if key_range is not None:
+                key_range = [None if bound is None else bound.encode() for bound in key_range]
+                runs = [keyRangeOf(run, key_range) for run in runs]
+            records = heapq.merge(*runs, key=itemgetter(0))
+            blocks, size = [], 0
+            for block in recordBlocks(records, msg.get('compress')):
+                blocks.append(block)
+                size += len(block)
+                if size >= FETCH_FRAME_BYTES:
+                    yield reply, b''.join(blocks)
+                    blocks, size = [], 0
+        yield dict(reply, more=False), b''.join(blocks)
+
+    def fetchPartition(self, host, sdfs_prefix, job_id, outputs, f, key_range=None, compress=False):
+        ''' Pull partitions of the maple output held by `host`, `outputs` being a list of
+        [maple tid, [partitions]], into the binary stream `f` frame by frame. Returns the
+        number of bytes written '''
+        msg = {
+            'type': MessageType.FETCH_PARTITION,
+            'from_vm': self.addr,
+            'from_node': self.host,
+            'sdfs_prefix': sdfs_prefix,
+            'job_id': job_id,
+            'outputs': outputs,
+            'key_range': key_range,
+            'compress': compress,
+        }
+        if host == self.host:
+            frames = self.servePartition(msg)
+        else:
+            frames = self.bulk.stream(nodeAddr(host, DEFAULT_PORT_MJ_DATANODE_BULK), msg)
+        written = 0
+        for reply, data in frames:
+            if reply['status'] != ErrorCode.Normal:
+                # the juice task would silently miss these keys, fail it instead
+                raise FileNotFoundError(f"partitions {outputs} from {host}: {reply['status']}")
+            f.write(data)
+            written += len(data)
+        return written
+
+    def combine(self, kvpairs, combiner, mode=None):
+        ''' Apply a built-in combiner, or the cached executable at `combiner`, to the output of one maple task '''
+        if combiner in COMBINERS:
+            return {k: COMBINERS[combiner](values) for k, values in kvpairs.items()}
+
+        # in function mode the combiner module's juice() folds each key's values
+        if mode == 'function':
+            with self.usePool(combiner, mode) as pool:
+                return pool.combine(kvpairs)
+
+        # executable combiner reads and writes `key value` lines, like a maple exe
+        data = b''.join(k + b' ' + v + b'\n' for k, values in kvpairs.items() for v in values)
+        with self.usePool(combiner) as pool:
+            return parseLines(pool.run(data))
+
+    def fetch(self, host, path, offset=0, length=-1):
+        ''' Read a byte range of a file on `host` over the bulk channel '''
+        if host == self.host:
+            return readSplit(path, offset, length)
+
+        msg = {
+            'type': MessageType.FETCH,
+            'from_vm': self.addr,
+            'from_node': self.host,
+            'file': path,
+            'offset': offset,
+            'length': length,
+        }
+        reply, data = self.bulk.request(nodeAddr(host, DEFAULT_PORT_MJ_NAMENODE_BULK), msg)
+        if reply['status'] != ErrorCode.Normal:
+            print(f"[ERROR-DataNode-fetch] Requested file: {path} Error: {reply['status']}")
+        return data
+
+    def fetchSplit(self, message):
+        ''' Read the (file, offset, length) split of a maple task, from the local SDFS replica of
+        the input if there is one, else from another replica or from the master '''
+        split = message['data']
+        if split.get('replicas') is None:
+            return self.fetch(message['from_node'], split['file'], split['offset'], split['length'])
+
+        if self.host in split['replicas'] and os.path.isfile(split['file']):
+            return readLines(split['file'], split['offset'], split['length'])
+
+        msg = {
+            'type': MessageType.FETCH,
+            'from_vm': self.addr,
+            'from_node': self.host,
+            'file': split['file'],
+            'offset': split['offset'],
+            'length': split['length'],
+            'lines': True,
+        }
+        for host in split['replicas']:
             try:
-                with SCPClient(ssh.get_transport()) as scp:
-                    scp.get(remote_path, juice_file_path)
-            except Exception as e:
-                print(e)
-                stdin, stdout, stderr=ssh.exec_command("ls")
-                print(stdout.readlines())
-                print(stderr.readlines())
-                pass
+                reply, data = self.bulk.request(nodeAddr(host, DEFAULT_PORT_MJ_DATANODE_BULK), msg)
+            except OSError:
+                continue
+            if reply['status'] == ErrorCode.Normal:
+                return data
+        print(f"[ERROR-DataNode-fetchSplit] no replica of {split['file']} reachable in {split['replicas']}")
+        return b''
 
-        filename_size = os.path.getsize(juice_file_path)
-        print(f"[INFO-DataNode-handleJob] [{juice_file}] successfully saved as [{juice_file_path}] of size [{filename_size}]")
+    def handleJuiceTask(self, message):
+        ''' Receives juice task and perform calculations on data '''
+        message['task_start'] = time.time()
+        mj_exe = self.ensureExe(message, message['mj_exe'])
+        if mj_exe is None:
+            raise FileNotFoundError(f"executable {message['mj_exe']} not available")
+
+        # Pull this task's share of the partitions from every maple worker, each as one sorted
+        # run spilled to a local file
+        share = message['data']
+        runs = []
+        message['input_bytes'] = 0
+        for source, (host, outputs) in enumerate(share['sources']):
+            path = runFile(message['sdfs_prefix'], message['job_id'], message['tid'], source)
+            with open(path, 'wb') as f:
+                message['input_bytes'] += self.fetchPartition(host, message['sdfs_prefix'], message['job_id'], outputs, f, share['key_range'], share.get('compress'))
+            runs.append(path)
+
+        print(f"[INFO-DataNode-handleJuiceTask] partitions {share['partitions']} range {share['key_range']} fetched, [{len(runs)}] runs")
+
+        # the runs are merged into one stream of contiguous key groups, reduced by one worker
+        # process a batch of keys per round trip, each key's values as its stdin and the key
+        # itself as sys.argv[1]. In function mode the batches go to juice() as lists of values,
+        # several of them at once across the FunctionPool's processes
+        mode = share.get('mode')
+        message['results'] = {}
+        with contextlib.ExitStack() as stack:
+            pool = stack.enter_context(self.usePool(mj_exe, mode))
+            batches = self.keyBatches([readRecords(stack.enter_context(open(path, 'rb'))) for path in runs], mode)
+            if mode == 'function':
+                for keys, outputs in pool.juiceBatches(batches):
+                    message['results'].update(zip(keys, outputs))
+            else:
+                for keys, blocks in batches:
+                    self.reduceBatch(pool, keys, blocks, message['results'])
+        for path in runs:
+            os.remove(path)
+        message['output_records'] = len(message['results'])
+
+        # a pipeline stage's output stays here, as `key result` lines for the next stage's maple
+        # tasks, and so does an output shard, for the master to store in SDFS from here
+        if share.get('keep_output'):
+            message['shard'] = self.writeOutput(stageFile(message['sdfs_prefix'], message['job_id'], message['tid']), message['results'])
+            message['results'] = {}
+        elif share.get('shard'):
+            message['shard'] = self.writeOutput(os.path.join(TMP_PATH, share['shard']), message['results'])
+            message['shard']['sdfs'] = share['shard']
+            message['results'] = {}
+        message['task_finish'] = time.time()
 
-        with open(juice_file_path, 'r') as f:
-            # subprocess
-            with subprocess.Popen(["python3", mj_exe], stdin=f, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as proc:
-                output = proc.stdout.read().decode()
-                print(output)
-                message['key'] = juice_file.split('#')[1]
-                message['result'] = output.rstrip('\n')
+        message['status'] = TaskStatus.PendingUpload
+        self.sendAcknowledgement(message, MessageType.TASK_ACK)
 
-            message['status'] = TaskStatus.PendingUpload
-            self.sendAcknowledgement(message, MessageType.TASK_ACK)
+    def writeOutput(self, path, results):
+        ''' Write juice results as `key result` lines to a local file, returns {'file', 'size'} '''
+        with open(path, 'w') as f:
+            for key, result in results.items():
+                f.write(f"{key} {result}\n")
+        return {'file': path, 'size': os.path.getsize(path)}
+
+    def keyBatches(self, runs, mode=None):
+        ''' Merge sorted runs into batches of (keys, inputs) of at most JUICE_BATCH_KEYS keys or
+        JUICE_BATCH_BYTES bytes, a key's input being its values as lines, or as a list of str
+        in function mode '''
+        keys, inputs, size = [], [], 0
+        for k, values in mergeRuns(runs):
+            keys.append(k.decode())
+            if mode == 'function':
+                inputs.append([v.decode() for v in values])
+                size += sum(len(v) for v in values)
+            else:
+                block = b''.join(v + b'\n' for v in values)
+                inputs.append(block)
+                size += len(block)
+            if len(keys) >= JUICE_BATCH_KEYS or size >= JUICE_BATCH_BYTES:
+                yield keys, inputs
+                keys, inputs, size = [], [], 0
+        if keys:
+            yield keys, inputs
+
+    def reduceBatch(self, pool, keys, blocks, results):
+        ''' Run the juice executable on a batch of keys in one worker round trip '''
+        for k, output in zip(keys, pool.runBatch(blocks, keys)):
+            results[k] = output.decode().rstrip('\n')
 
     def sendAcknowledgement(self, message, msg_type):
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            namenode_vm = tuple(message['from_vm'])
-            message['from_vm'] = self.addr
-            message['type'] = msg_type
-            message['timestamp'] = time.time()
-            data = json.dumps(message).encode('UTF-8')
-            sock.sendto(data, namenode_vm)
+        namenode_vm = tuple(message['from_vm'])
+        namenode = message['from_node']
+        message['from_vm'] = self.addr
+        message['from_node'] = self.host
+        message['type'] = msg_type
+        message['timestamp'] = time.time()
+
+        # task results go over the bulk channel
+        if msg_type == MessageType.TASK_ACK:
+            self.bulk.send(nodeAddr(namenode, DEFAULT_PORT_MJ_NAMENODE_BULK), message)
+        else:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                data = json.dumps(message).encode('UTF-8')
+                sock.sendto(data, namenode_vm)
 
         if DEBUG:
-            print(f"[DEBUG-MJDataNode-sendAck] sent a {msg_type} ACK of size {len(data)} to master {message['from_vm']}")
+            print(f"[DEBUG-MJDataNode-sendAck] sent a {msg_type} ACK to master {namenode_vm}")
 
     def print(self):
         # Print all local sdfs files 
@@ -215,21 +534,49 @@ class DataNodeServer:
         while True:
             data, _ = sock.recvfrom(16384)
             msg = json.loads(data.decode('UTF-8'))
+            self.handleMessage(msg)
+
+    def bulkReceiver(self):
+        BulkServer(self.bulkAddr, self.handleBulkMessage, name="MJDataNodeBulkServer").run()
+
+    def handleBulkMessage(self, msg, payload):
+        ''' messages on the bulk channel, FETCH(_PARTITION) is answered on the same connection '''
+        if msg['type'] == MessageType.FETCH_PARTITION:
+            return self.servePartition(msg)
+        if msg['type'] == MessageType.FETCH:
+            return serveFetch(msg)
+        self.handleMessage(msg)
 
-            if DEBUG:
-                print(f"[DEBUG-MJDataNode-receiver] received message from {msg['from_vm']} of type {msg['type']}")
-
-            if msg['type'] == MessageType.TASK:
-                if (msg['task_type'] == TaskType.Maple):
-                    thread = threading.Thread(target=self.handleMapleTask, args=(msg,))
-                    thread.start()
-                elif (msg['task_type'] == TaskType.Juice):
-                    # thread = threading.Thread(target=self.handleJuiceTask, args=(msg,))
-                    self.handleJuiceTask(msg)
-                #self.handleReplicateRequest(msg)
-            elif msg['type'] == MessageType.JOB:
-                thread = threading.Thread(target=self.handleJob, args=(msg, ))
-                thread.start()
+    def handleMessage(self, msg):
+        ''' dispatch a control or bulk channel message '''
+        if DEBUG:
+            print(f"[DEBUG-MJDataNode-receiver] received message from {msg['from_vm']} of type {msg['type']}")
+
+        if msg['type'] == MessageType.TASK:
+            if (msg['task_type'] == TaskType.Maple):
+                self.executor.submit(self.runTask, self.handleMapleTask, msg)
+            elif (msg['task_type'] == TaskType.Juice):
+                self.executor.submit(self.runTask, self.handleJuiceTask, msg)
+        elif msg['type'] == MessageType.JOB:
+            thread = threading.Thread(target=self.handleJob, args=(msg, ))
+            thread.start()
+        elif msg['type'] == MessageType.JOB_CLEANUP:
+            self.handleJobCleanup(msg)
+
+    def runTask(self, handler, msg):
+        ''' run a task in a slot. A task that raises, e.g. because a maple worker it pulls from
+        died, is acknowledged as failed so the master frees its slot and re-runs it '''
+        namenode_vm, namenode = msg['from_vm'], msg['from_node']
+        try:
+            handler(msg)
+        except Exception:
+            traceback.print_exc()
+            failure = {k: msg[k] for k in ('job_id', 'task_type', 'tid')}
+            failure.update(from_vm=namenode_vm, from_node=namenode, status=TaskStatus.Failed)
+            try:
+                self.sendAcknowledgement(failure, MessageType.TASK_ACK)
+            except OSError:
+                traceback.print_exc()
 
     def clear_sdfs_files(self):
         if os.path.exists(SDFS_PATH):
@@ -241,7 +588,7 @@ class DataNodeServer:
         self.clear_sdfs_files()
 
         threads = []
-        workers = [self.receiver,]
+        workers = [self.receiver, self.bulkReceiver]
         for worker in workers:
             threads.append(threading.Thread(target=worker))
         for thread in threads:
@@ -5,14 +5,15 @@ import socket
 import random
 import threading
 import shutil
-from collections import defaultdict
+import traceback
+from collections import defaultdict, OrderedDict
 import subprocess
 import threading
-from paramiko import SSHClient, AutoAddPolicy
-from scp import SCPClient
 
 from logger import Logger
+from ssh_pool import SSH_POOL
 from membership import MembershipServer
+from maplejuice_transport import BulkChannel, BulkServer
 
 from sdfs_utils import (
     SDFSFile,
@@ -21,27 +22,37 @@ from sdfs_utils import (
 )
 
 from maplejuice_utils import (
+    COMBINERS,
+    cacheExe,
+    serveFetch,
     Job,
     JobStatus,
+    Pipeline,
     Task,
     TaskStatus,
     TaskType,
     # ErrorCodeMJ,
 )
 
-from credentials import (
-    USERNAME,
-    PASSWORD,
-)
-
 from constants import (
+    NODE_ID,
     DEFAULT_PORT_MJ_NAMENODE,
     DEFAULT_PORT_MJ_DATANODE,
+    DEFAULT_PORT_MJ_NAMENODE_BULK,
+    DEFAULT_PORT_MJ_DATANODE_BULK,
     DEFAULT_PRIMARY_NAMENODE_HOST,
     DEFAULT_BACKUP_NAMENODE_HOSTS,
-    MAPLE_BLOCK_SIZE,
+    MJ_SCHEDULER_TIMEOUT,
+    MJ_JOB_HISTORY,
+    MJ_WORKER_SLOTS,
+    MJ_TASK_MAX_FAILURES,
+    JUICE_MERGE_CHUNK_BYTES,
     SDFS_PATH,
+    SSH_RETRY_DELAY,
     TMP_PATH,
+    nodeAddr,
+    nodeId,
+    nodeHost,
 )
 
 from message import (
@@ -53,21 +64,36 @@ DEBUG = False
 
 class NameNodeServer:
     def __init__(self, mem_server, sdfs_namenode):
-        self.host = socket.gethostname()
-        self.addr = (self.host, DEFAULT_PORT_MJ_NAMENODE)
+        self.host = NODE_ID
+        self.addr = nodeAddr(self.host, DEFAULT_PORT_MJ_NAMENODE)
+        self.bulkAddr = nodeAddr(self.host, DEFAULT_PORT_MJ_NAMENODE_BULK)
+        self.bulk = BulkChannel()
         
         self.primary = False
         self.masterHost = DEFAULT_PRIMARY_NAMENODE_HOST
-        self.masterAddr = (self.masterHost, DEFAULT_PORT_MJ_NAMENODE)
+        self.masterAddr = nodeAddr(self.masterHost, DEFAULT_PORT_MJ_NAMENODE)
 
         self.membershipList = mem_server
         self.sdfs_namenode = sdfs_namenode
         self.activeHosts = []
 
         self.lock = threading.Lock()
+        # notified on every job/task state change so the scheduler reacts immediately
+        self.cond = threading.Condition(self.lock)
         self.logger = Logger(name="MJNameNodeServer").logger
 
-        self.jobList = []
+        # job table, job id -> Job, jobs run concurrently and share the workers
+        self.jobs = {}
+        self.nextJobId = 0
+        # finished jobs, oldest first, kept for `stats`
+        self.doneJobs = OrderedDict()
+        # task slots advertised by each worker, and the attempts running on them as
+        # (job id, task type, tid, worker), a worker only gets a task while it has a free slot
+        self.slots = {}
+        self.running = set()
+        # task attempts recorded by the current scheduling pass as (task, worker, attempt, message),
+        # sent once the pass is over and the lock released
+        self.outbox = []
 
         if os.path.isdir('tmp'):
             shutil.rmtree('tmp')
@@ -75,188 +101,196 @@ class NameNodeServer:
         os.mkdir('tmp')
 
 
-    def handleClientRequest(self, msg_type, mj_exe, num_workers, sdfs_prefix, sdfs_src_file, delete_input=False):
+    def handleClientRequest(self, msg_type, mj_exe, num_workers, sdfs_prefix, sdfs_src_file, delete_input=False, **options):
         if self.primary:
             if DEBUG:
                 print(f"[DEBUG-MJNameNode-handleClient] self is primary, process {msg_type}, MJ executable: {mj_exe}, number of workers: {num_workers}, sdfs intermediate prefix: {sdfs_prefix}, sdfs location: {sdfs_src_file}, delete input: {delete_input}")
             if msg_type == 'maple':
-                self.handleMaple(self.host, mj_exe, num_workers, sdfs_prefix, sdfs_src_file)
+                self.handleMaple(self.host, mj_exe, num_workers, sdfs_prefix, sdfs_src_file, **options)
             elif msg_type == 'juice':
-                self.handleJuice(self.host, mj_exe, num_workers, sdfs_prefix, sdfs_src_file, delete_input)
+                self.handleJuice(self.host, mj_exe, num_workers, sdfs_prefix, sdfs_src_file, delete_input, **options)
         else:
             if DEBUG:
                 print(f"[DEBUG-MJNameNode-handleClient] self isn't primary, send to {self.masterHost} of message {msg_type}, MJ executable: {mj_exe}, number of workers: {num_workers}, sdfs intermediate prefix: {sdfs_prefix}, sdfs location: {sdfs_src_file}, delete input: {delete_input}")
             
-            job = Job(mj_exe, num_workers, sdfs_prefix, sdfs_src_file)
+            job = Job(mj_exe, num_workers, sdfs_prefix, sdfs_src_file, **options)
             self.sendInstruction(self.masterHost, job, msg_type, port=DEFAULT_PORT_MJ_NAMENODE)
 
-    def handleMaple(self, maple_host, mj_exe, num_maples, sdfs_prefix, sdfs_src_file):
-        ''' handle maple requests from client (or other non-master nodes) '''
-        with self.lock:
-            maple_start_time = time.time()
+    def handlePipelineRequest(self, stages, num_workers, sdfs_prefix, sdfs_src_file, sdfs_dest_filename, **options):
+        pipeline = Pipeline(stages, num_workers, sdfs_prefix, sdfs_src_file, sdfs_dest_filename, **options)
+        if self.primary:
+            self.handlePipeline(self.host, pipeline)
+        else:
             if DEBUG:
-                print(f"[DEBUG-MJNameNode-handleMaple] master received maple message, MJ executable: {mj_exe}, number of workers: {num_maples}, sdfs intermediate prefix: {sdfs_prefix}, sdfs location: {sdfs_src_file}")
-            
-            if maple_host == self.host:
-                mj_exe_path = os.path.join(TMP_PATH, mj_exe)
-                sdfs_src_file_path = os.path.join(TMP_PATH, sdfs_src_file)
-                shutil.copy(mj_exe, mj_exe_path)
-                shutil.copy(sdfs_src_file, sdfs_src_file_path)
-            else:
-            # 2. Get sdfs_src_file to local dir if it's remote
-            # self.nameNode.handleClientRequest(MessageType.GET, sdfs_src_file)
-                ssh = SSHClient()
-                ssh.load_system_host_keys()
-                # ssh.set_missing_host_key_policy(AutoAddPolicy())
-                # TODO: !!! Assuming maple initializer have mj_exe in its SDFS folder
-                ssh.connect(hostname = maple_host,
-                            username = USERNAME,
-                            password = PASSWORD)
-
-                mj_exe_path = os.path.join(TMP_PATH, mj_exe)
-                remote_mj_exe_path = os.path.join('mp3', mj_exe)
-                sdfs_src_file_path = os.path.join(TMP_PATH, sdfs_src_file)
-                remote_sdfs_src_file_path = os.path.join('mp3', sdfs_src_file)
-
-                # Save mj_exe to tmp
-                while mj_exe not in os.listdir(TMP_PATH):
-                    try:
-                        with SCPClient(ssh.get_transport()) as scp:
-                            scp.get(remote_mj_exe_path, mj_exe_path)
-                    except Exception as e:
-                        print(e)
-                        stdin, stdout, stderr=ssh.exec_command("ls")
-                        print(stdout.readlines())
-                        print(stderr.readlines())
-                        pass
-
-                # Save sdfs_src_file to tmp
-                while sdfs_src_file not in os.listdir(TMP_PATH):
-                    try:
-                        with SCPClient(ssh.get_transport()) as scp:
-                            scp.get(remote_sdfs_src_file_path, sdfs_src_file_path)
-                    except:
-                        pass
-
-            # 3. Schedules the job
-            # 3. Push the job to job queue
-            self.jobList.append(Job(mj_exe, num_maples, sdfs_prefix, sdfs_src_file))
-            self.jobList[0].maple_start_time = maple_start_time
-
-    # TODO: finish this function
-    def scheduler(self):
-        ''' regularly checks job list and schedule tasks to active nodes '''
-        while True:
-            time.sleep(3)
-            if self.primary == False or len(self.jobList) == 0:
-                continue
+                print(f"[DEBUG-MJNameNode-handleClient] self isn't primary, send pipeline {stages} to {self.masterHost}")
+            self.sendInstruction(self.masterHost, pipeline, MessageType.PIPELINE, port=DEFAULT_PORT_MJ_NAMENODE)
+
+    def handlePipeline(self, client_host, pipeline):
+        ''' handle a pipeline request: one job per stage, all submitted at once. Every stage but the
+        first gets its maple tasks from the previous stage as its juice tasks finish '''
+        start_time = time.time()
+        sdfs_input = self.locateInput(pipeline.sdfs_src_file)
+        exes = pipeline.exes()
+        self.fetchClientFiles(client_host, exes if sdfs_input else exes + [pipeline.sdfs_src_file])
+        exe_digests = {exe: cacheExe(os.path.join(TMP_PATH, exe)) for exe in exes}
 
-            with self.lock:
-                job = self.jobList[0]
-
-                # 1. if the job is pending, ask nodes to get mj_exe
-                if (job.status == JobStatus.Initialize):
-                    print(f"[DEBUG-MJNameNode-scheduler] Initialize")
-                    # a. Get the workers for this job
-                    if len(self.activeHosts) <= job.num_workers:
-                        job.workers = self.activeHosts
-                        job.num_workers = len(job.workers)
-                    else:
-                        job.workers = self.activeHosts[0:job.num_workers-1]
-                    
-                    # c. set job status
-                    job.status = JobStatus.Prepare
-
-                    # b. Ask worker to get mj_exe in its local directory
-                    for worker in job.workers:
-                        self.sendInstruction(worker, job, MessageType.JOB, DEFAULT_PORT_MJ_DATANODE)
-
-                elif (job.status == JobStatus.Prepare):
-                    print(f"[DEBUG-MJNameNode-scheduler] Prepare, workers {self.jobList[0].workers}, ready_workers {self.jobList[0].ready_workers}")
-                    pass
-
-                # 2. schedule tasks and ask nodes to do them.
-                elif (job.status == JobStatus.PendingMaple):
-                    print(f"[DEBUG-MJNameNode-scheduler] PendingMaple")
-                    job.assignMapleTask()
-
-                    # send maple tasks to nodes
-                    for task in job.tasks:
-                        self.sendInstruction(task.worker, task, MessageType.TASK, DEFAULT_PORT_MJ_DATANODE)
-                        task.status = TaskStatus.Assigned
-                        time.sleep(0.01)
-
-                    job.status = JobStatus.RunningMaple
-                    
-                # 3. if job is running, see if there are any failed nodes in job 
-                # (should be marked failed by checker and handleNodeFail already), 
-                # and reschedules the tasks to other alive nodes.
-                elif (job.status == JobStatus.RunningMaple):
-                    print(f"[DEBUG-MJNameNode-scheduler] RunningMaple")
-                    print(f"{len(job.finished_tasks)}/{len(job.tasks)}")
-                    pass
-
-                # 4. combine maple output / or sort?
-                elif (job.status == JobStatus.CombiningMaple):
-                    print(f"[DEBUG-MJNameNode-scheduler] CombiningMaple")
-                    pass
-                    
-                elif (job.status == JobStatus.PendingJuice):
-                    print(f"[DEBUG-MJNameNode-scheduler] PendingJuice")
-                    pass
-
-                elif (job.status == JobStatus.RunningJuice):
-                    print(f"[DEBUG-MJNameNode-scheduler] RunningJuice")
-                    # print(job.tasks)
-                    # print(job.finished_tasks)
-                    pass
-
-                elif (job.status == JobStatus.Done):
-                    print(f"[DEBUG-MJNameNode-scheduler] Done")
-                    print(f"Maple Time: {job.maple_end_time - job.maple_start_time}")
-                    print(f"Juice Time: {job.juice_end_time - job.juice_start_time}")
-                    self.jobList = []
-                    pass
-
-    def handleJuice(self, juice_host, mj_exe, num_workers, sdfs_prefix, sdfs_dest_filename, delete_input=False):
-        juice_start_time = time.time()
-        if juice_host == self.host:
-            mj_exe_path = os.path.join(TMP_PATH, mj_exe)
-            shutil.copy(mj_exe, mj_exe_path)
-        else:
-        # 2. Get sdfs_src_file to local dir if it's remote
-        # self.nameNode.handleClientRequest(MessageType.GET, sdfs_src_file)
-            ssh = SSHClient()
-            ssh.load_system_host_keys()
-            # ssh.set_missing_host_key_policy(AutoAddPolicy())
-            # TODO: !!! Assuming maple initializer have mj_exe in its SDFS folder
-            ssh.connect(hostname = juice_host,
-                        username = USERNAME,
-                        password = PASSWORD)
+        with self.lock:
+            jobs = pipeline.makeJobs(exe_digests, sdfs_input)
+            for job in jobs:
+                job.job_id = self.nextJobId
+                self.nextJobId += 1
+                self.jobs[job.job_id] = job
+            jobs[0].maple_start_time = start_time
+            self.cond.notify_all()
+        print(f"[INFO-MJNameNode-handlePipeline] pipeline jobs {jobs[0].job_id}-{jobs[-1].job_id} submitted with prefix {pipeline.sdfs_prefix}")
+
+    def handleMaple(self, maple_host, mj_exe, num_maples, sdfs_prefix, sdfs_src_file, **options):
+        ''' handle maple requests from client (or other non-master nodes) '''
+        maple_start_time = time.time()
+        if DEBUG:
+            print(f"[DEBUG-MJNameNode-handleMaple] master received maple message, MJ executable: {mj_exe}, number of workers: {num_maples}, sdfs intermediate prefix: {sdfs_prefix}, sdfs location: {sdfs_src_file}")
+        
+        # an executable combiner is shipped to the workers along with mj_exe
+        combiner = options.get('combiner')
+        exes = [mj_exe]
+        if combiner and combiner not in COMBINERS:
+            exes.append(combiner)
+
+        # an input stored in SDFS is read by the workers from its replicas, others are copied here
+        sdfs_input = self.locateInput(sdfs_src_file)
 
-            mj_exe_path = os.path.join(TMP_PATH, mj_exe)
-            remote_mj_exe_path = os.path.join('mp3', mj_exe)
+        self.fetchClientFiles(maple_host, exes if sdfs_input else exes + [sdfs_src_file])
 
-            # Save mj_exe to tmp
-            while mj_exe not in os.listdir(TMP_PATH):
+        # workers fetch the executables by content hash, only if they don't have them cached
+        exe_digests = {exe: cacheExe(os.path.join(TMP_PATH, exe)) for exe in exes}
+
+        # 3. Add the job to the job table and wake up the scheduler
+        with self.lock:
+            job = Job(mj_exe, num_maples, sdfs_prefix, sdfs_src_file, **options)
+            job.exes = exe_digests
+            job.input = sdfs_input
+            job.job_id = self.nextJobId
+            job.maple_start_time = maple_start_time
+            self.nextJobId += 1
+            self.jobs[job.job_id] = job
+            self.cond.notify_all()
+        print(f"[INFO-MJNameNode-handleMaple] job {job.job_id} submitted with prefix {sdfs_prefix}")
+
+    def fetchClientFiles(self, client_host, names):
+        ''' copy files named in a client request to tmp, from the client's `mp3` folder if it is remote '''
+        for name in names:
+            path = os.path.join(TMP_PATH, name)
+            if client_host == self.host:
+                shutil.copy(name, path)
+                continue
+            # TODO: !!! Assuming maple initializer have mj_exe in its SDFS folder
+            while name not in os.listdir(TMP_PATH):
                 try:
-                    with SCPClient(ssh.get_transport()) as scp:
-                        scp.get(remote_mj_exe_path, mj_exe_path)
+                    SSH_POOL.get(nodeHost(client_host), os.path.join('mp3', name), path)
                 except Exception as e:
                     print(e)
-                    stdin, stdout, stderr=ssh.exec_command("ls")
-                    print(stdout.readlines())
-                    print(stderr.readlines())
-                    pass
-
-        job = self.jobList[0]
-        if job.status == JobStatus.PendingJuice:
-            job.mj_exe = mj_exe
-            job.sdfs_src_file = sdfs_dest_filename
-            job.num_workers = num_workers
+                    time.sleep(SSH_RETRY_DELAY)
+
+    def locateInput(self, sdfs_src_file):
+        ''' replicas and size of an input stored in SDFS as {'file', 'size', 'replicas'},
+        None if SDFS has no ready copy of it '''
+        with self.sdfs_namenode.lock:
+            sdfsFile = self.sdfs_namenode.fileTable.get(sdfs_src_file)
+            if sdfsFile is None or sdfsFile.status == FileStatus.Deleted or not sdfsFile.replicas:
+                return None
+            path = os.path.join(SDFS_PATH, sdfsFile.sdfsname)
+            replicas = list(sdfsFile.replicas)
+
+        # the size is all the master needs to plan the splits
+        for host in sorted(replicas, key=lambda h: h != self.host):
+            if host == self.host and os.path.isfile(path):
+                return {'file': path, 'size': os.path.getsize(path), 'replicas': replicas}
+            msg = {'type': MessageType.FETCH, 'from_vm': self.addr, 'from_node': self.host, 'file': path, 'offset': 0, 'length': 0}
+            try:
+                reply, _ = self.bulk.request(nodeAddr(host, DEFAULT_PORT_MJ_DATANODE_BULK), msg)
+            except OSError:
+                continue
+            if reply['status'] == ErrorCode.Normal:
+                return {'file': path, 'size': reply['size'], 'replicas': replicas}
+        return None
 
-            if os.path.isfile(sdfs_dest_filename):
-                os.remove(sdfs_dest_filename)
+    def scheduler(self):
+        ''' schedules every job in the job table whenever a state changes: JOB_ACK/TASK_ACK handlers,
+        client requests and the membership checker notify `self.cond`, the timeout is a fallback '''
+        while True:
+            with self.cond:
+                progressed = False
+                if self.primary:
+                    for job in list(self.jobs.values()):
+                        # one job going wrong mustn't stop the scheduler for every other job
+                        try:
+                            progressed |= self.schedule(job)
+                        except Exception:
+                            traceback.print_exc()
+                sends, self.outbox = self.outbox, []
+                # some job moved on, look at the jobs again right away
+                if not progressed and not sends:
+                    self.cond.wait(timeout=MJ_SCHEDULER_TIMEOUT)
+            # a worker slow to accept a connection mustn't hold up the acknowledgements and the checker
+            self.sendTasks(sends)
+
+    def schedule(self, job):
+        ''' act on the job's current state, returns True if the state changed (called with lock held) '''
+        # 1. if the job is pending, ask nodes to get mj_exe (unless they have it cached)
+        if (job.status == JobStatus.Initialize):
+            print(f"[DEBUG-MJNameNode-scheduler] Initialize")
+            # a. Get the workers for this job
+            # hosts with a replica of the input first, so splits can be read locally
+            replicas = job.input['replicas'] if job.input else []
+            hosts = sorted(self.activeHosts, key=lambda h: h not in replicas)
+            if len(hosts) <= job.num_workers:
+                job.workers = hosts
+                job.num_workers = len(job.workers)
+            else:
+                job.workers = hosts[0:job.num_workers-1]
+            
+            # c. set job status
+            job.status = JobStatus.Prepare
+
+            # b. Ask worker to get mj_exe in its local directory
+            for worker in job.workers:
+                self.sendInstruction(worker, job, MessageType.JOB, DEFAULT_PORT_MJ_DATANODE)
+            return True
+
+        # 2. schedule tasks and ask nodes to do them.
+        elif (job.status == JobStatus.PendingMaple):
+            print(f"[DEBUG-MJNameNode-scheduler] PendingMaple")
+            if job.upstream is None:
+                job.assignMapleTask()
+            else:
+                # a pipeline stage's maple tasks are added as the previous stage's output comes in
+                job.tasks = []
+                job.finished_tasks = defaultdict(bool)
+                job.maple_start_time = job.maple_start_time or time.time()
+
+            # maple tasks are sent to nodes as their slots free up
+            job.status = JobStatus.RunningMaple
+            return True
+
+        # 3. start the juice phase as soon as both the maple phase and the juice request are done
+        elif (job.status == JobStatus.PendingJuice and job.juice is not None):
+            print(f"[DEBUG-MJNameNode-scheduler] PendingJuice")
+            juice = job.juice
+            if job.maple is None:
+                job.maple = {'mj_exe': job.mj_exe, 'exes': job.exes, 'sdfs_src_file': job.sdfs_src_file, 'workers': job.workers, 'tasks': job.tasks}
+            job.mj_exe = juice['mj_exe']
+            job.exes = juice['exes']
+            job.sdfs_src_file = juice['sdfs_dest_filename']
+            job.num_workers = juice['num_workers']
+            job.partitioner = juice['partitioner'] or job.partitioner
+            if juice.get('shards') is not None:
+                job.shards = bool(int(juice['shards']))
+            if juice.get('merge') is not None:
+                job.merge = bool(int(juice['merge']))
+
+            # keep the results of shares done before a failure sent the job back to maple
+            if job.sdfs_src_file is not None and os.path.isfile(job.sdfs_src_file) and not job.juice_done:
+                os.remove(job.sdfs_src_file)
 
             if len(self.activeHosts) <= job.num_workers:
                 job.workers = self.activeHosts
@@ -264,115 +298,517 @@ class NameNodeServer:
             else:
                 job.workers = self.activeHosts[0:int(job.num_workers)-1]
 
-            job.assignJuiceTask()
+            job.assignJuiceTask(job.partitioner or 'hash')
 
+            job.status = JobStatus.RunningJuice
+            # a juice request queued during the maple phase only starts juice once maple is done
+            job.juice_start_time = max(juice['start_time'] or 0, job.maple_end_time or 0) or time.time()
+            if not job.tasks:
+                job.status = JobStatus.Done
+                job.juice_end_time = time.time()
+            return True
+
+        elif (job.status == JobStatus.Failed):
+            print(f"[ERROR-MJNameNode-scheduler] Job {job.job_id} failed: {job.error}")
+            self.retireJob(job)
+            return True
+
+        elif (job.status == JobStatus.Done):
+            print(f"[DEBUG-MJNameNode-scheduler] Job {job.job_id} Done")
+            print(f"Maple Time: {job.maple_end_time - job.maple_start_time}")
+            print(f"Juice Time: {job.juice_end_time - job.juice_start_time}")
+            if job.output_shards and not job.merge:
+                print(f"Output: {len(job.output_shards)} shards {job.sdfs_src_file}.part-* in SDFS")
+            self.retireJob(job)
+            return True
+
+        # a pipeline stage runs maple tasks on the previous stage's output as soon as it is written
+        elif (job.status == JobStatus.RunningMaple and job.upstream is not None):
+            job.addStageTasks()
+            if len(job.finished_tasks) == len(job.tasks) and job.stageInputDone():
+                job.status = JobStatus.PendingJuice
+                job.maple_end_time = time.time()
+                return True
 
+        # Prepare / RunningMaple / RunningJuice wait for acknowledgements
+        if job.status in (JobStatus.RunningMaple, JobStatus.RunningJuice):
+            self.dispatchPending(job)
+            self.speculate(job)
+        if DEBUG:
+            print(f"[DEBUG-MJNameNode-scheduler] Job {job.job_id} {job.status}, {len(job.finished_tasks)}/{len(job.tasks)} tasks done")
+        return False
+
+    def retireJob(self, job):
+        ''' move a finished or failed job from the job table to the history and have its intermediate
+        files deleted, a pipeline stage's output once the next stage is over (called with lock held) '''
+        del self.jobs[job.job_id]
+        self.running = set(attempt for attempt in self.running if attempt[0] != job.job_id)
+        self.doneJobs[job.job_id] = job
+        if len(self.doneJobs) > MJ_JOB_HISTORY:
+            self.doneJobs.popitem(last=False)
+        self.cleanupJob(job, keep_output=job.downstream is not None)
+        if job.upstream is not None:
+            self.cleanupJob(job.upstream)
+
+    def cleanupJob(self, job, keep_output=False):
+        ''' tell every node to delete the job's files from its tmp, any of them may have run one of
+        its attempts (called with lock held) '''
+        message = {
+            'type': MessageType.JOB_CLEANUP,
+            'from_vm': self.addr,
+            'from_node': self.host,
+            'job_id': job.job_id,
+            'sdfs_prefix': job.sdfs_prefix,
+            'keep_output': keep_output,
+            'timestamp': time.time(),
+        }
+        body = json.dumps(message).encode('UTF-8')
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for host in self.activeHosts:
+                sock.sendto(body, nodeAddr(host, DEFAULT_PORT_MJ_DATANODE))
+
+    def failJob(self, job, error):
+        ''' give up on a job, and on the stages of its pipeline that aren't done yet (called with lock held) '''
+        while job.upstream is not None:
+            job = job.upstream
+        while job is not None:
+            if job.status not in (JobStatus.Done, JobStatus.Failed):
+                job.status = JobStatus.Failed
+                job.error = error
+            job = job.downstream
+        self.cond.notify_all()
+
+    def freeSlots(self, worker):
+        ''' slots of `worker` not running an attempt (called with lock held) '''
+        busy = sum(1 for attempt in self.running if attempt[3] == worker)
+        return self.slots.get(worker, MJ_WORKER_SLOTS) - busy
+
+    def dispatchPending(self, job):
+        ''' send the job's unassigned tasks to their workers while those have free slots, older
+        jobs are scheduled first and so get freed slots first (called with lock held) '''
+        now = time.time()
+        for task in job.tasks:
+            if task.status != TaskStatus.PendingAssign:
+                continue
+            # a task that just failed waits a scheduler period, its cause may be a node failure
+            # the membership list is about to report
+            if task.failed_at is not None and now - task.failed_at < MJ_SCHEDULER_TIMEOUT:
+                continue
+            if task.worker not in job.workers:
+                task.worker = job.backupWorker(task)
+                if task.worker is None:
+                    continue
+            if self.freeSlots(task.worker) > 0:
+                self.dispatchTask(task, task.worker)
+
+    def dispatchTask(self, task, worker):
+        ''' record an attempt of `task` on `worker`, taking one of its slots, and queue it to be
+        sent at the end of the scheduling pass, see sendTasks (called with lock held) '''
+        self.running.add((task.job_id, task.task_type, task.tid, worker))
+        now = time.time()
+        if task.start_time is None:
+            task.start_time = now
+        attempt = [worker, now]
+        task.attempts.append(attempt)
+        task.worker = worker
+        task.status = TaskStatus.Assigned
+        self.outbox.append((task, worker, attempt, self.instruction(task, MessageType.TASK)))
+
+    def sendTasks(self, sends):
+        ''' send the task attempts queued by a scheduling pass over the bulk channel, without the
+        lock held. A worker that can't be reached is probably dead but not out of the membership
+        list yet: its attempts are undone, and the rest of the pass isn't sent to it '''
+        unreachable = set()
+        for task, worker, attempt, message in sends:
+            if worker not in unreachable:
+                try:
+                    self.bulk.send(nodeAddr(worker, DEFAULT_PORT_MJ_DATANODE_BULK), message)
+                    continue
+                except OSError as e:
+                    print(f"[ERROR-MJNameNode-sendTasks] job {task.job_id} {task.task_type} task {task.tid} not sent to {worker}: {e}")
+                    unreachable.add(worker)
+            with self.lock:
+                self.undoAttempt(task, worker, attempt)
+
+    def undoAttempt(self, task, worker, attempt):
+        ''' forget an attempt that couldn't be sent, the task is sent again once it has a live worker
+        with a free slot (called with lock held) '''
+        self.running.discard((task.job_id, task.task_type, task.tid, worker))
+        # the task may have been reset meanwhile, e.g. by handleNodeFail
+        if not any(a is attempt for a in task.attempts):
+            return
+        task.attempts = [a for a in task.attempts if a is not attempt]
+        if task.attempts:
+            task.worker = task.attempts[-1][0]
+        elif task.status == TaskStatus.Assigned:
+            task.status = TaskStatus.PendingAssign
+            task.start_time = None
+            task.failed_at = time.time()
+
+    def speculate(self, job):
+        ''' start a backup attempt of every straggling task on another worker, whichever
+        attempt acknowledges first wins and the other one is discarded (called with lock held) '''
+        for task in job.stragglers(time.time()):
+            worker = job.backupWorker(task)
+            if worker is None or self.freeSlots(worker) <= 0:
+                continue
+            print(f"[INFO-MJNameNode-speculate] job {job.job_id} {task.task_type} task {task.tid} straggling on {task.worker}, backup attempt on {worker}")
+            self.dispatchTask(task, worker)
 
-            for task in job.tasks:
-                self.sendInstruction(task.worker, task, MessageType.TASK, DEFAULT_PORT_MJ_DATANODE)
-                time.sleep(0.02)
-                task.status = TaskStatus.Assigned
+    def handleJuice(self, juice_host, mj_exe, num_workers, sdfs_prefix, sdfs_dest_filename, delete_input=False, **options):
+        juice_start_time = time.time()
+        self.fetchClientFiles(juice_host, [mj_exe])
+        exe_digests = {mj_exe: cacheExe(os.path.join(TMP_PATH, mj_exe))}
 
-            job.status = JobStatus.RunningJuice
-            job.juice_start_time = juice_start_time
-
-    # TODO: Reallocate failed tasks to other active nodes
-    # def handleNodeFail(self, failed_hosts):
-    #     ''' reallocate file when node fails, given a list of failed hosts '''
-    #     failed_hosts = set(failed_hosts)        
-
-    #     # Loop through file table to check for impacted files
-    #     for sdfsFile in self.fileTable.values():
-    #         if sdfsFile.status == FileStatus.Deleted:
-    #             continue
-    #         elif set(sdfsFile.replicas).isdisjoint(failed_hosts) and \
-    #                 set(sdfsFile.assigned).isdisjoint(failed_hosts):
-    #             continue
-            
-    #         sdfsFile.replicas = list(set(sdfsFile.replicas) - failed_hosts)
-    #         sdfsFile.assigned = list(set(sdfsFile.replicas) - failed_hosts)
-                
-    #         if len(sdfsFile.assigned) == 0:
-    #             sdfsFile.status = FileStatus.Deleted
-    #         else:
-    #             sdfsFile.status = FileStatus.PendingReplication
-    #             new_replicas = sdfsFile.assign_replicas(self.activeHosts)
-    #             for host in new_replicas:
-    #                 self.sendInstruction(host, sdfsFile, MessageType.REP_REQ)
+        # the juice phase is started by the scheduler once the maple phase is done
+        with self.lock:
+            job = self.findJuiceJob(sdfs_prefix)
+            if job is None:
+                print(f"[ERROR-MJNameNode-handleJuice] no maple job with prefix {sdfs_prefix}")
+                return
+            job.juice = {
+                'mj_exe': mj_exe,
+                'exes': exe_digests,
+                'num_workers': int(num_workers),
+                'sdfs_dest_filename': sdfs_dest_filename,
+                'partitioner': options.get('partitioner'),
+                'shards': options.get('shards'),
+                'merge': options.get('merge'),
+                'start_time': juice_start_time,
+            }
+            self.cond.notify_all()
+
+    def printJobs(self):
+        ''' print the job table '''
+        fmt = '{:<5} {:<15} {:<18} {:<10}'
+        print(fmt.format("Job", "Prefix", "Status", "Tasks"))
+        print(fmt.format("-" * 5, "-" * 15, "-" * 18, "-" * 10))
+        with self.lock:
+            for job in self.jobs.values():
+                print(fmt.format(job.job_id, job.sdfs_prefix, job.status, f"{len(job.finished_tasks)}/{len(job.tasks)}"))
+
+    def printStats(self, job_id):
+        ''' print the timeline of a running or finished job and dump it as a Chrome trace '''
+        with self.lock:
+            job = self.jobs.get(job_id) or self.doneJobs.get(job_id)
+            if job is None:
+                print(f"[ERROR] no job {job_id}")
+                return
+            timeline = list(job.timeline)
+            trace = job.trace()
+            phases = [('Maple', job.maple_start_time, job.maple_end_time), ('Juice', job.juice_start_time, job.juice_end_time)]
+
+        print(f"Job {job_id} ({job.status})")
+        for phase, start, end in phases:
+            if start is not None and end is not None:
+                print(f"{phase} Time: {end - start:.3f}")
+
+        fmt = '{:<7} {:<5} {:<35} {:>8} {:>8} {:>9} {:>12} {:>9} {:>8}'
+        print(fmt.format("Phase", "Task", "Worker", "Queued", "Run", "Ack", "Input Bytes", "Records", "Attempts"))
+        print(fmt.format("-" * 7, "-" * 5, "-" * 35, "-" * 8, "-" * 8, "-" * 9, "-" * 12, "-" * 9, "-" * 8))
+        for entry in timeline:
+            queued = run = '-'
+            if entry['start'] is not None and entry['finish'] is not None:
+                queued = f"{entry['start'] - entry['dispatch']:.3f}"
+                run = f"{entry['finish'] - entry['start']:.3f}"
+            print(fmt.format(entry['phase'], entry['tid'], entry['worker'], queued, run, f"{entry['ack'] - entry['dispatch']:.3f}", entry['input_bytes'] or 0, entry['output_records'] or 0, entry['attempts']))
+
+        path = f"mj_job{job_id}_trace.json"
+        with open(path, 'w') as f:
+            json.dump(trace, f)
+        print(f"Timeline written to {path}")
+
+    def findJuiceJob(self, sdfs_prefix):
+        ''' the oldest job with this intermediate prefix still waiting for a juice request '''
+        for job in self.jobs.values():
+            if job.sdfs_prefix == sdfs_prefix and job.juice is None:
+                return job
+        return None
+
+    def handleNodeFail(self, failed_hosts):
+        ''' re-run the tasks lost with the failed hosts on the jobs' remaining workers: tasks they
+        had not acknowledged yet and maple tasks whose output they held (called with lock held) '''
+        failed_hosts = set(failed_hosts)
+        self.running = set(attempt for attempt in self.running if attempt[3] not in failed_hosts)
+
+        # output of a pipeline stage only lives on the worker that wrote it, start over if it's gone
+        for job in list(self.jobs.values()):
+            if job.upstream is not None and job.status not in (JobStatus.Done, JobStatus.Failed) and job.lostStageInput(failed_hosts):
+                print(f"[INFO-MJNameNode-nodeFail] pipeline job {job.job_id} lost output of the previous stage, restarting the pipeline")
+                self.restartPipeline(job)
+
+        for job in list(self.jobs.values()):
+            if job.status in (JobStatus.Initialize, JobStatus.Done, JobStatus.Failed):
+                continue
+            lost = [tid for tid, (host, _, _) in job.maple_outputs.items() if host in failed_hosts]
+            if set(job.workers).isdisjoint(failed_hosts) and not lost:
+                continue
+
+            # juice tasks still to run would pull the lost maple output, redo those maple tasks first
+            if job.status == JobStatus.RunningJuice and lost:
+                print(f"[INFO-MJNameNode-nodeFail] job {job.job_id} lost the output of maple tasks {lost}, back to maple")
+                job.resumeMaple()
+
+            live = [w for w in job.workers if w not in failed_hosts]
+            if not live:
+                print(f"[INFO-MJNameNode-nodeFail] job {job.job_id} lost all its workers, restarting it")
+                job.restart()
+                continue
+            job.workers = live
+            job.ready_workers = [w for w in job.ready_workers if w in live]
+
+            if job.status == JobStatus.Prepare:
+                if set(job.ready_workers) == set(job.workers):
+                    job.status = JobStatus.PendingMaple
+                continue
+            elif job.status == JobStatus.PendingMaple:
+                continue
+
+            for tid in lost:
+                job.resetTask(job.tasks[tid])
+            if lost and job.status == JobStatus.PendingJuice:
+                job.status = JobStatus.RunningMaple
+
+            for task in job.tasks:
+                if task.status == TaskStatus.Assigned and all(worker in failed_hosts for worker, _ in task.attempts):
+                    job.resetTask(task)
+                # re-run on another worker once it has a free slot, see dispatchPending
+                if task.status == TaskStatus.PendingAssign and task.worker in failed_hosts:
+                    task.worker = job.backupWorker(task)
+                    print(f"[INFO-MJNameNode-nodeFail] job {job.job_id} re-running {task.task_type} task {task.tid} on {task.worker} (retry {task.retries})")
  
-    def updateJobStatus(self, host, status):
-        ''' updates job status whenever a JOB_ACK is received '''
+    def restartPipeline(self, job):
+        ''' start every stage of `job`'s pipeline over from its input (called with lock held) '''
+        while job.upstream is not None:
+            job = job.upstream
+        while job is not None:
+            job.restart()
+            job.juice_shares = None
+            job.juice_done = []
+            job.output_shards = []
+            job.stage_inputs = []
+            self.doneJobs.pop(job.job_id, None)
+            self.jobs[job.job_id] = job
+            job = job.downstream
+
+    def updateJobStatus(self, host, job_id, status, slots=None, error=None):
+        ''' updates job status whenever a JOB_ACK is received, a Failed one coming from a worker
+        that couldn't get the job's executables '''
         if DEBUG:
-            print(f"[DEBUG-MJNameNode-updateJobStatus] {host} {status}")
+            print(f"[DEBUG-MJNameNode-updateJobStatus] {host} {job_id} {status}")
 
         with self.lock:
-            if (status == JobStatus.Prepare):
-                if host not in self.jobList[0].ready_workers:
-                    self.jobList[0].ready_workers.append(host)
-                if (set(self.jobList[0].ready_workers) == set(self.jobList[0].workers)):
-                    self.jobList[0].status = JobStatus.PendingMaple
-
-    def updateTaskStatus(self, tid, sdfs_prefix, kvpairs):
-        ''' updates task status whenever a TASK_ACK is received '''
+            if slots:
+                self.slots[host] = slots
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            if job.status != JobStatus.Prepare:
+                return
+            if (status == JobStatus.Failed):
+                print(f"[ERROR-MJNameNode-updateJobStatus] job {job_id}: {host} couldn't get the executables: {error}")
+                job.workers = [w for w in job.workers if w != host]
+                job.ready_workers = [w for w in job.ready_workers if w != host]
+                if not job.workers:
+                    self.failJob(job, f"no worker could get the executables, last error: {error}")
+                    return
+            elif (status == JobStatus.Prepare):
+                if host not in job.ready_workers:
+                    job.ready_workers.append(host)
+            if (set(job.ready_workers) == set(job.workers)):
+                job.status = JobStatus.PendingMaple
+                self.cond.notify_all()
+
+    def taskFailed(self, job_id, task_type, tid, host):
+        ''' an attempt raised on its worker, e.g. a juice task whose maple worker died before the
+        membership list noticed. The task is re-run once it has no other attempt left, unless it
+        already failed MJ_TASK_MAX_FAILURES times, then its job fails '''
+        with self.lock:
+            job = self.jobs.get(job_id)
+            running = {TaskType.Maple: JobStatus.RunningMaple, TaskType.Juice: JobStatus.RunningJuice}
+            if job is None or job.status != running.get(task_type) or tid >= len(job.tasks):
+                return
+            task = job.tasks[tid]
+            if task.status != TaskStatus.Assigned:
+                return
+            task.failures += 1
+            print(f"[INFO-MJNameNode-taskFailed] job {job_id} {task_type} task {tid} failed on {host} ({task.failures}/{MJ_TASK_MAX_FAILURES})")
+            if task.failures >= MJ_TASK_MAX_FAILURES:
+                self.failJob(job, f"{task_type} task {tid} failed {task.failures} times, last on {host}")
+                return
+            task.attempts = [attempt for attempt in task.attempts if attempt[0] != host]
+            if task.attempts:
+                task.worker = task.attempts[-1][0]
+                return
+            job.resetTask(task)
+            task.failed_at = time.time()
+            self.cond.notify_all()
+
+    def updateTaskStatus(self, job_id, tid, host, partition_sizes, key_sample, stats):
+        ''' updates task status whenever a TASK_ACK is received, the maple output itself
+        stays partitioned on `host` until juice workers pull it '''
         if DEBUG:
-            print(f"[DEBUG-MJNameNode-updateTaskStatus] {tid}")
+            print(f"[DEBUG-MJNameNode-updateTaskStatus] {job_id} {tid}")
 
-        # write packet returned result to intermediate file
-        for k in kvpairs.keys():
-            # map intermediate result filename
-            intermediate_file_path = sdfs_prefix + '#' + k
-            intermediate_file_path = os.path.join('tmp', intermediate_file_path)
-            
-            # write to file
-            with open(intermediate_file_path, 'a') as f:
-                for v in kvpairs[k]:
-                    f.write(f"{v}\n")
-
-        # update current job status
+        # update the job's status
         with self.lock:
-            job = self.jobList[0]
-            job.tasks[tid].status = TaskStatus.Done
+            job = self.jobs.get(job_id)
+            if job is None or job.status != JobStatus.RunningMaple:
+                return
+            task = job.tasks[tid]
+            if task.status == TaskStatus.Done:
+                # another attempt of this task finished first, its output is the one used
+                if DEBUG:
+                    print(f"[DEBUG-MJNameNode-updateTaskStatus] discarding duplicate maple task {tid} from {host}")
+                return
+            job.maple_outputs[tid] = [host, partition_sizes, key_sample]
+            task.status = TaskStatus.Done
+            task.end_time = time.time()
+            job.recordTask(task, host, stats)
             job.finished_tasks[tid] = True
-            if len(job.finished_tasks) == len(job.tasks):
+            if len(job.finished_tasks) == len(job.tasks) and job.stageInputDone():
                 # job.status = JobStatus.CombiningMaple
                 job.status = JobStatus.PendingJuice
                 job.maple_end_time = time.time()
+                self.cond.notify_all()
 
-    def updateTaskStatus2(self, tid, sdfs_prefix, result, data):
-        ''' updates task status whenever a TASK_ACK is received '''
+    def updateTaskStatus2(self, job_id, tid, host, results, stats, shard=None):
+        ''' updates task status whenever a TASK_ACK is received, a pipeline stage's output
+        `shard` ({'file', 'size'}) stays on `host` and is handed to the next stage instead,
+        and an output shard ({'file', 'size', 'sdfs'}) is stored in SDFS from `host` '''
         if DEBUG:
-            print(f"[DEBUG-MJNameNode-updateTaskStatus2] {tid}")
+            print(f"[DEBUG-MJNameNode-updateTaskStatus2] {job_id} {tid}")
 
         with self.lock:
-            job = self.jobList[0]
+            job = self.jobs.get(job_id)
+            if job is None or job.status != JobStatus.RunningJuice:
+                return
+            task = job.tasks[tid]
+            if task.status != TaskStatus.Assigned:
+                # another attempt of this task got here first, drop these results
+                if DEBUG:
+                    print(f"[DEBUG-MJNameNode-updateTaskStatus2] discarding duplicate juice task {tid}")
+                return
+            # claim the task so a slower attempt can't append its results as well
+            task.status = TaskStatus.PendingUpload
+            job.juice_done.append([task.data['partitions'], task.data['key_range']])
             sdfs_dest_filename = job.sdfs_src_file
 
-        with open(sdfs_dest_filename, 'a') as f:
-            key = data.split('#')[1]
-            f.write(f"{key} {result}\n")
+        if shard is None:
+            with open(sdfs_dest_filename, 'a') as f:
+                for key, result in results.items():
+                    f.write(f"{key} {result}\n")
+        elif 'sdfs' in shard:
+            # the worker copies the shard into its SDFS directory, SDFS replicates it from there
+            self.sdfs_namenode.handlePut(host, shard['sdfs'], shard['file'])
 
-        # update current job status
+        # update the job's status
         with self.lock:
-            job = self.jobList[0]
-            job.tasks[tid].status = TaskStatus.Done
+            task.status = TaskStatus.Done
+            task.end_time = time.time()
+            job.recordTask(task, host, stats)
+            if shard is not None and 'sdfs' in shard:
+                job.output_shards.append([shard['sdfs'], host, shard['file']])
+            elif shard is not None and shard['size'] > 0:
+                job.downstream.stage_inputs.append([host, shard['file'], shard['size']])
+                self.cond.notify_all()
+            # a failure sent the job back to maple meanwhile, its share is still recorded as done
+            if task not in job.tasks:
+                return
             job.finished_tasks[tid] = True
-            if len(job.finished_tasks) == len(job.tasks):
+            if len(job.finished_tasks) < len(job.tasks):
+                return
+            if not (job.merge and job.output_shards):
                 job.status = JobStatus.Done
                 job.juice_end_time = time.time()
+                self.cond.notify_all()
+                return
+            output_shards = sorted(job.output_shards)
+
+        # the last task is in, concatenate the shards in share order (key order if range partitioned)
+        missing = self.mergeShards(output_shards, sdfs_dest_filename)
+        with self.lock:
+            if job.status == JobStatus.RunningJuice and len(job.finished_tasks) == len(job.tasks):
+                if missing is not None:
+                    self.failJob(job, f"output shard {missing} couldn't be read, {sdfs_dest_filename} not merged (the shards are still in SDFS)")
+                    return
+                job.status = JobStatus.Done
+                job.juice_end_time = time.time()
+                self.cond.notify_all()
+
+    def mergeShards(self, output_shards, sdfs_dest_filename):
+        ''' concatenate output shards, given as [sdfs name, worker, file on the worker], into
+        `sdfs_dest_filename` here. Returns None, or the name of a shard that couldn't be read from
+        its worker nor from any SDFS replica, `sdfs_dest_filename` then not being written '''
+        merging = sdfs_dest_filename + '.merging'
+        missing = None
+        with open(merging, 'wb') as out:
+            for name, host, path in output_shards:
+                if not self.copyShard(out, self.shardSources(name, host, path)):
+                    missing = name
+                    break
+        if missing is not None:
+            print(f"[ERROR-MJNameNode-mergeShards] couldn't read {missing}, {sdfs_dest_filename} not merged")
+            os.remove(merging)
+            return missing
+        os.replace(merging, sdfs_dest_filename)
+        print(f"[INFO-MJNameNode-mergeShards] {len(output_shards)} shards merged into {sdfs_dest_filename}")
+        return None
+
+    def shardSources(self, name, host, path):
+        ''' where an output shard can be read from as [(node, file)]: the worker that wrote it, then
+        the nodes holding its SDFS replicas '''
+        sources = [(host, path)]
+        with self.sdfs_namenode.lock:
+            sdfsFile = self.sdfs_namenode.fileTable.get(name)
+            if sdfsFile is not None and sdfsFile.status != FileStatus.Deleted:
+                sources += [(replica, os.path.join(SDFS_PATH, sdfsFile.sdfsname)) for replica in sdfsFile.replicas]
+        return sources
+
+    def copyShard(self, out, sources):
+        ''' append a shard to `out`, read over the bulk channel in JUICE_MERGE_CHUNK_BYTES requests from
+        the first of `sources` serving it. A source failing part way is taken over by the next one
+        from the same offset. Returns False if none of them could serve the whole shard '''
+        offset = 0
+        for host, path in sources:
+            if host == self.host and os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    shutil.copyfileobj(f, out)
+                return True
+            while True:
+                msg = {'type': MessageType.FETCH, 'from_vm': self.addr, 'from_node': self.host, 'file': path, 'offset': offset, 'length': JUICE_MERGE_CHUNK_BYTES}
+                try:
+                    reply, data = self.bulk.request(nodeAddr(host, DEFAULT_PORT_MJ_DATANODE_BULK), msg)
+                except OSError:
+                    break
+                if reply['status'] != ErrorCode.Normal:
+                    break
+                out.write(data)
+                offset += len(data)
+                if len(data) < JUICE_MERGE_CHUNK_BYTES:
+                    return True
+            print(f"[INFO-MJNameNode-copyShard] couldn't read {path} from {host} at offset {offset}, trying the next copy")
+        return False
+
+    def instruction(self, data, msg_type):
+        ''' the message sending `data` (a Job, Task or Pipeline) to another node '''
+        message = data.dictify()
+        message['from_vm'] = self.addr
+        message['from_node'] = self.host
+        message['type'] = msg_type
+        message['timestamp'] = time.time()
+        return message
 
     def sendInstruction(self, host, data, msg_type, port):
-        ''' send instruction to the target host '''
-        to_vm = (host, port)
+        ''' send instruction to the target host, over UDP (tasks go over the bulk channel, see sendTasks) '''
+        to_vm = nodeAddr(host, port)
         if DEBUG:
             print(f"[DEBUG-MJNameNode-sendInstr] send message {msg_type} to address: {to_vm}")
 
+        message = self.instruction(data, msg_type)
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            message = data.dictify()
-            message['from_vm'] = self.addr
-            message['type'] = msg_type
-            message['timestamp'] = time.time()
             body = json.dumps(message).encode('UTF-8')
-
             sock.sendto(body, to_vm)
 
     def checker(self):
@@ -380,13 +816,13 @@ class NameNodeServer:
             time.sleep(1)
             ml = self.membershipList.mem_list
             with ml.lock:
-                cur_active_hosts = [x.address[0] for x in ml.list.values()]
+                cur_active_hosts = [nodeId(x.address) for x in ml.list.values()]
                 
             with self.lock:
                 # Get newest host (DON'T need to)
                 if len(cur_active_hosts) >= 4 and self.masterHost not in cur_active_hosts:
                     self.masterHost = min(cur_active_hosts)
-                    self.masterAddr = (self.masterHost, DEFAULT_PORT_MJ_NAMENODE)
+                    self.masterAddr = nodeAddr(self.masterHost, DEFAULT_PORT_MJ_NAMENODE)
 
                 # Check if self is the primary master (DON'T need to)
                 self.primary = True if (self.masterAddr == self.addr) else False
@@ -394,6 +830,8 @@ class NameNodeServer:
                 # Update active hosts based on the membership list
                 prev_active_hosts = self.activeHosts.copy()
                 self.activeHosts = cur_active_hosts
+                if set(prev_active_hosts) != set(self.activeHosts):
+                    self.cond.notify_all()
             
                 # Check for failed nodes
                 failed_hosts = set(prev_active_hosts) - set(self.activeHosts)
@@ -403,7 +841,8 @@ class NameNodeServer:
                         print(f"[DEBUG-MJNameNode-nodeFail] Previous active hosts: {prev_active_hosts}")
                         print(f"[DEBUG-MJNameNode-nodeFail] New active hosts: {self.activeHosts}")
                         ml.print()
-                    # self.handleNodeFail(failed_hosts)
+                    self.handleNodeFail(failed_hosts)
+                    self.cond.notify_all()
 
     # TODO: Modify this function for MapReduce jobs/tasks
     # receive updates on local files from data nodes
@@ -413,48 +852,72 @@ class NameNodeServer:
         while True:
             data, _ = sock.recvfrom(16384)
             msg = json.loads(data.decode('UTF-8'))
-            host = msg['from_vm'][0]
+            self.handleMessage(msg)
 
-            if DEBUG:
-                print(f"[DEBUG-NameNode-receiver] received message from {msg['from_vm']} of type {msg['type']}")
-
-            # Client requests (from other non-primary name nodes)
-            if msg['type'] == MessageType.MAPLE:
-                mj_exe = msg['mj_exe']
-                num_maples = msg['num_workers']
-                sdfs_prefix = msg['sdfs_prefix']
-                sdfs_src_file = msg['sdfs_src_file']
-                # thread = threading.Thread(target=self.handleMaple, args=(host, mj_exe, num_maples, sdfs_prefix, sdfs_src_file,))
-                # thread.start()
-                self.handleMaple(host, mj_exe, num_maples, sdfs_prefix, sdfs_src_file)
-            elif msg['type'] == MessageType.JUICE:
-                mj_exe = msg['mj_exe']
-                num_juices = msg['num_workers']
-                sdfs_prefix = msg['sdfs_prefix']
-                sdfs_src_file = msg['sdfs_src_file']
-                # delete_input = msg['delete_input']
-                # thread = threading.Thread(target=self.handleJuice, args=(host, mj_exe, num_juices, sdfs_prefix, sdfs_src_file,))
-                # thread.start()
-                self.handleJuice(host, mj_exe, num_juices, sdfs_prefix, sdfs_src_file)
-
-            # Datanode acknowledgement
-            elif msg['type'] == MessageType.JOB_ACK:
-                self.updateJobStatus(host, msg['status'])
-
-            elif msg['type'] == MessageType.TASK_ACK:
-                if msg['task_type'] == TaskType.Maple:
-                    thread = threading.Thread(target=self.updateTaskStatus, args=(msg['tid'], msg['sdfs_prefix'], msg['kvpairs'],))
-                    thread.start()
-                    # self.updateTaskStatus(msg['tid'], msg['sdfs_prefix'], msg['kvpairs'])
-                elif msg['task_type'] == TaskType.Juice:
-                    thread = threading.Thread(target=self.updateTaskStatus2, args=(msg['tid'], msg['sdfs_prefix'], msg['result'], msg['data'],))
-                    thread.start()
-                    # self.updateTaskStatus2(msg['tid'], msg['sdfs_prefix'], msg['result'], msg['data'])
+    def bulkReceiver(self):
+        BulkServer(self.bulkAddr, self.handleBulkMessage, name="MJNameNodeBulkServer").run()
+
+    def handleBulkMessage(self, msg, payload):
+        ''' messages on the bulk channel, FETCH is answered on the same connection '''
+        if msg['type'] == MessageType.FETCH:
+            return serveFetch(msg)
+        self.handleMessage(msg)
+
+    def handleMessage(self, msg):
+        ''' dispatch a control or bulk channel message '''
+        host = msg['from_node']
+
+        if DEBUG:
+            print(f"[DEBUG-NameNode-receiver] received message from {msg['from_vm']} of type {msg['type']}")
+
+        # Client requests (from other non-primary name nodes)
+        if msg['type'] == MessageType.MAPLE:
+            mj_exe = msg['mj_exe']
+            num_maples = msg['num_workers']
+            sdfs_prefix = msg['sdfs_prefix']
+            sdfs_src_file = msg['sdfs_src_file']
+            options = {k: msg[k] for k in Job.OPTIONS if msg.get(k) is not None}
+            # thread = threading.Thread(target=self.handleMaple, args=(host, mj_exe, num_maples, sdfs_prefix, sdfs_src_file,))
+            # thread.start()
+            self.handleMaple(host, mj_exe, num_maples, sdfs_prefix, sdfs_src_file, **options)
+        elif msg['type'] == MessageType.JUICE:
+            mj_exe = msg['mj_exe']
+            num_juices = msg['num_workers']
+            sdfs_prefix = msg['sdfs_prefix']
+            sdfs_src_file = msg['sdfs_src_file']
+            # a forwarded request carries every setting, unset ones as None/False
+            options = {k: msg[k] for k in ('partitioner', 'shards', 'merge') if msg.get(k)}
+            # delete_input = msg['delete_input']
+            # thread = threading.Thread(target=self.handleJuice, args=(host, mj_exe, num_juices, sdfs_prefix, sdfs_src_file,))
+            # thread.start()
+            self.handleJuice(host, mj_exe, num_juices, sdfs_prefix, sdfs_src_file, **options)
+        elif msg['type'] == MessageType.PIPELINE:
+            pipeline = Pipeline(msg['stages'], msg['num_workers'], msg['sdfs_prefix'], msg['sdfs_src_file'], msg['sdfs_dest_filename'], **msg['options'])
+            self.handlePipeline(host, pipeline)
+
+        # Datanode acknowledgement
+        elif msg['type'] == MessageType.JOB_ACK:
+            self.updateJobStatus(host, msg['job_id'], msg['status'], msg.get('slots'), msg.get('error'))
+
+        elif msg['type'] == MessageType.TASK_ACK:
+            stats = {k: msg.get(k) for k in ('task_start', 'task_finish', 'input_bytes', 'output_records')}
+            # the attempt's slot is free whether or not its result is still wanted
+            with self.lock:
+                self.running.discard((msg['job_id'], msg['task_type'], msg['tid'], host))
+                self.cond.notify_all()
+            if msg['status'] == TaskStatus.Failed:
+                self.taskFailed(msg['job_id'], msg['task_type'], msg['tid'], host)
+            elif msg['task_type'] == TaskType.Maple:
+                thread = threading.Thread(target=self.updateTaskStatus, args=(msg['job_id'], msg['tid'], host, msg['partition_sizes'], msg['key_sample'], stats,))
+                thread.start()
+            elif msg['task_type'] == TaskType.Juice:
+                thread = threading.Thread(target=self.updateTaskStatus2, args=(msg['job_id'], msg['tid'], host, msg['results'], stats, msg.get('shard'),))
+                thread.start()
 
     # TODO: Modify this function for MapReduce jobs/tasks
     def run(self):
         threads = []
-        workers = [self.receiver, self.checker, self.scheduler]
+        workers = [self.receiver, self.bulkReceiver, self.checker, self.scheduler]
         for worker in workers:
             threads.append(threading.Thread(target=worker))
         for thread in threads:
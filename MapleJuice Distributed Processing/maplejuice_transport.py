@@ -0,0 +1,166 @@
+import json
+import socket
+import struct
+import threading
+from collections import defaultdict
+
+from logger import Logger
+
+DEBUG = False
+
+# frame = header length, payload length, JSON header, raw payload bytes
+FRAME_HEADER = struct.Struct('!II')
+# seconds a bulk channel waits to connect to a node, and for any single send/recv on the
+# connection, so a node that stopped answering fails the request instead of blocking it forever
+CONNECT_TIMEOUT = 5
+IO_TIMEOUT = 60
+# idle connections a bulk channel keeps open to each node, more are opened while needed
+MAX_IDLE_CONNECTIONS = 4
+
+def recvExactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def sendFrame(sock, msg, payload=b''):
+    ''' Send one message (JSON-able dict) followed by an optional binary payload '''
+    header = json.dumps(msg).encode('UTF-8')
+    sock.sendall(FRAME_HEADER.pack(len(header), len(payload)) + header)
+    if payload:
+        sock.sendall(payload)
+
+def recvFrame(sock):
+    ''' Receive one frame as (msg, payload), None if the connection was closed '''
+    sizes = recvExactly(sock, FRAME_HEADER.size)
+    if sizes is None:
+        return None
+    header_len, payload_len = FRAME_HEADER.unpack(sizes)
+    header = recvExactly(sock, header_len)
+    payload = recvExactly(sock, payload_len) if payload_len else b''
+    if header is None or payload is None:
+        return None
+    return json.loads(header.decode('UTF-8')), payload
+
+class BulkChannel:
+    ''' Persistent TCP connections to other nodes for task payloads and results. UDP is
+    still used for small control messages, anything that can grow with the data goes here.
+    Each exchange, a whole streamed reply included, has a connection of its own: an idle one to
+    the node if there is one, else a new one, kept afterwards if fewer than MAX_IDLE_CONNECTIONS
+    are idle. Concurrent requests to a node therefore don't queue behind each other '''
+    def __init__(self):
+        # address -> idle connections
+        self.idle = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def checkout(self, addr):
+        ''' a connection to `addr` and whether it was idle, in which case it may have gone stale '''
+        with self.lock:
+            if self.idle[addr]:
+                return self.idle[addr].pop(), True
+        sock = socket.create_connection(addr, timeout=CONNECT_TIMEOUT)
+        sock.settimeout(IO_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, False
+
+    def checkin(self, addr, sock):
+        with self.lock:
+            if len(self.idle[addr]) < MAX_IDLE_CONNECTIONS:
+                self.idle[addr].append(sock)
+                return
+        sock.close()
+
+    def exchange(self, addr, msg, payload, reply):
+        ''' Send one message to `addr` and read the first reply frame if `reply` is set. Returns the
+        connection, still checked out, and the frame '''
+        # an idle connection that went stale is dropped and the message sent on the next one,
+        # a new connection failing is the node's failure
+        while True:
+            sock, idle = self.checkout(addr)
+            try:
+                sendFrame(sock, msg, payload)
+                frame = recvFrame(sock) if reply else None
+                if reply and frame is None:
+                    raise ConnectionError(f"connection to {addr} closed")
+                return sock, frame
+            except OSError:
+                sock.close()
+                if not idle:
+                    raise
+            except BaseException:
+                sock.close()
+                raise
+
+    def send(self, addr, msg, payload=b''):
+        ''' Send one message to `addr` without waiting for a reply '''
+        addr = tuple(addr)
+        sock, _ = self.exchange(addr, msg, payload, reply=False)
+        self.checkin(addr, sock)
+
+    def request(self, addr, msg, payload=b''):
+        ''' Send one message to `addr` and wait for its (msg, payload) reply '''
+        addr = tuple(addr)
+        sock, frame = self.exchange(addr, msg, payload, reply=True)
+        self.checkin(addr, sock)
+        return frame
+
+    def stream(self, addr, msg, payload=b''):
+        ''' Send one message to `addr` and yield its (msg, payload) reply frames, up to the first
+        one without `more` set. The connection is only put back once the whole reply is read,
+        and dropped if the caller stops half way through it '''
+        addr = tuple(addr)
+        sock, frame = self.exchange(addr, msg, payload, reply=True)
+        complete = False
+        try:
+            while True:
+                yield frame
+                if not frame[0].get('more'):
+                    complete = True
+                    return
+                frame = recvFrame(sock)
+                if frame is None:
+                    raise ConnectionError(f"connection to {addr} closed")
+        finally:
+            if complete:
+                self.checkin(addr, sock)
+            else:
+                sock.close()
+
+class BulkServer:
+    ''' Accepts bulk channel connections and calls `handler(msg, payload)` for every frame.
+    If the handler returns a (msg, payload) tuple it is sent back on the same connection, if it
+    returns an iterator of them they are sent back one after the other (see BulkChannel.stream) '''
+    def __init__(self, addr, handler, name="BulkServer"):
+        self.addr = addr
+        self.handler = handler
+        self.logger = Logger(name=name).logger
+
+    def serveConnection(self, conn):
+        with conn:
+            while True:
+                frame = recvFrame(conn)
+                if frame is None:
+                    break
+                reply = self.handler(*frame)
+                if isinstance(reply, tuple):
+                    sendFrame(conn, *reply)
+                elif reply is not None:
+                    for part in reply:
+                        sendFrame(conn, *part)
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self.addr)
+        sock.listen()
+        while True:
+            conn, from_addr = sock.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if DEBUG:
+                print(f"[DEBUG-BulkServer-run] accepted bulk connection from {from_addr}")
+            thread = threading.Thread(target=self.serveConnection, args=(conn,))
+            thread.start()
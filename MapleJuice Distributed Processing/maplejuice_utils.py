@@ -1,23 +1,295 @@
 import os
 import sys
 import json
+import struct
+import zlib
+import hashlib
+import heapq
 import random
+import itertools
+from operator import itemgetter
+import statistics
 from collections import defaultdict
 
+from sdfs_utils import ErrorCode
+from message import MessageType
+
 from constants import (
-    MAPLE_BLOCK_SIZE,
+    MAPLE_SPLIT_SIZE,
+    MAPLE_MIN_SPLIT_SIZE,
+    MAPLE_TASKS_PER_WORKER,
+    MAPLE_NUM_PARTITIONS,
+    KV_BLOCK_SIZE,
+    MJ_SPECULATIVE_MULTIPLIER,
+    MJ_SPECULATIVE_MIN_DONE,
+    MJ_SPECULATIVE_MIN_RUNTIME,
     SDFS_PATH,
     TMP_PATH,
+    EXE_CACHE_PATH,
 )
 
 DEBUG = True
 
+def planSplits(path, split_size):
+    ''' Cut `path` into byte ranges of roughly `split_size` bytes, returned as a list of
+    (offset, length). Each boundary is moved forward to the end of the line it falls in,
+    so only one seek + readline is done per split instead of reading the whole file '''
+    size = os.path.getsize(path)
+    splits = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            end = start + split_size
+            if end >= size:
+                end = size
+            else:
+                f.seek(end - 1)
+                f.readline()
+                end = f.tell()
+            splits.append((start, end - start))
+            start = end
+    return splits
+
+def splitSize(file_size, num_workers, split_bytes=None, tasks_per_worker=None):
+    ''' Pick the split size for an input of `file_size` bytes so that the number of maple
+    tasks follows the number of workers (`tasks_per_worker` each) rather than the number of
+    input lines, capped at `split_bytes` per task for large inputs '''
+    split_bytes = int(split_bytes or MAPLE_SPLIT_SIZE)
+    tasks_per_worker = int(tasks_per_worker or MAPLE_TASKS_PER_WORKER)
+    num_tasks = max(1, num_workers * tasks_per_worker)
+    size = -(-file_size // num_tasks)
+    return max(MAPLE_MIN_SPLIT_SIZE, min(split_bytes, size))
+
+def readSplit(path, offset, length):
+    ''' Read the byte range of a split from a local file '''
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+def readLines(path, offset, length):
+    ''' Read the lines starting in the byte range of a split from a local file. Splits can then
+    be cut at any byte without reading the file: the first partial line belongs to the previous
+    split and the last line is read to its end '''
+    end = offset + length
+    with open(path, 'rb') as f:
+        if offset > 0:
+            f.seek(offset - 1)
+            f.readline()
+        start = f.tell()
+        if start >= end:
+            return b''
+        data = f.read(end - start)
+        if data and not data.endswith(b'\n'):
+            data += f.readline()
+        return data
+
+def toNumber(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+# Built-in map-side combiners, each folds the list of values emitted for one key
+# (as bytes) into a shorter list. Only valid for associative juice functions.
+COMBINERS = {
+    'sum': lambda values: [str(sum(toNumber(v) for v in values)).encode()],
+    'count': lambda values: [str(len(values)).encode()],
+    'min': lambda values: [min(values, key=toNumber)],
+    'max': lambda values: [max(values, key=toNumber)],
+}
+# How each built-in combiner folds values it already folded, e.g. a key combined in several
+# maple spills: partial counts are summed rather than counted
+COMBINER_MERGES = {
+    'sum': COMBINERS['sum'],
+    'count': COMBINERS['sum'],
+    'min': COMBINERS['min'],
+    'max': COMBINERS['max'],
+}
+
+def partitionOf(key, num_partitions):
+    ''' Partition of an intermediate key (bytes), a stable hash since hash() is salted per process '''
+    return zlib.crc32(key) % num_partitions
+
+def parseLines(output):
+    ''' Group the `key value` lines printed by a maple/combiner executable by key, as bytes '''
+    kvpairs = defaultdict(list)
+    for line in output.split(b'\n'):
+        k, sep, v = line.partition(b' ')
+        if sep:
+            kvpairs[k].append(v)
+    return kvpairs
+
+# Intermediate data is a sequence of blocks (flags, payload length, payload), the payload
+# being length-prefixed (key, value) records, zlib-compressed if the block's flag says so
+KV_BLOCK = struct.Struct('!BI')
+KV_RECORD = struct.Struct('!II')
+KV_ZLIB = 1
+
+def packBlock(parts, compress):
+    ''' One block of packed records, header included '''
+    payload = b''.join(parts)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, 1)
+        flags |= KV_ZLIB
+    return KV_BLOCK.pack(flags, len(payload)) + payload
+
+def recordBlocks(records, compress=False):
+    ''' Pack (key, value) byte pairs into blocks of about KV_BLOCK_SIZE, yielded as they fill up '''
+    parts, size = [], 0
+    for key, value in records:
+        parts.append(KV_RECORD.pack(len(key), len(value)))
+        parts.append(key)
+        parts.append(value)
+        size += KV_RECORD.size + len(key) + len(value)
+        if size >= KV_BLOCK_SIZE:
+            yield packBlock(parts, compress)
+            parts, size = [], 0
+    if parts:
+        yield packBlock(parts, compress)
+
+def writeRecords(f, records, compress=False):
+    ''' Write (key, value) byte pairs to a binary stream, returns the number of bytes written '''
+    written = 0
+    for block in recordBlocks(records, compress):
+        f.write(block)
+        written += len(block)
+    return written
+
+def readRecords(f):
+    ''' Iterate the (key, value) byte pairs of a binary stream written by writeRecords '''
+    while True:
+        header = f.read(KV_BLOCK.size)
+        if len(header) < KV_BLOCK.size:
+            return
+        flags, length = KV_BLOCK.unpack(header)
+        payload = f.read(length)
+        if flags & KV_ZLIB:
+            payload = zlib.decompress(payload)
+        pos, end = 0, len(payload)
+        while pos < end:
+            key_len, value_len = KV_RECORD.unpack_from(payload, pos)
+            pos += KV_RECORD.size
+            key = payload[pos:pos + key_len]
+            pos += key_len
+            yield key, payload[pos:pos + value_len]
+            pos += value_len
+
+def keyRangeOf(run, key_range):
+    ''' The records of a run sorted by key whose key falls in the [lo, hi) key range, None bounds
+    being open. Records below `lo` are skipped and the run isn't read past `hi` '''
+    lo, hi = key_range
+    if lo is not None:
+        run = itertools.dropwhile(lambda record: record[0] < lo, run)
+    if hi is not None:
+        run = itertools.takewhile(lambda record: record[0] < hi, run)
+    return run
+
+def sampleKeys(sample, num_seen, keys, size):
+    ''' Reservoir-sample `size` keys over successive calls, `num_seen` being the number of keys
+    offered so far. Returns the new count '''
+    for k in keys:
+        num_seen += 1
+        if len(sample) < size:
+            sample.append(k)
+        else:
+            i = random.randrange(num_seen)
+            if i < size:
+                sample[i] = k
+    return num_seen
+
+def keyRanges(sample, num_ranges):
+    ''' Cut the sorted key sample into `num_ranges` [lo, hi) ranges of about equal size '''
+    sample = sorted(set(sample))
+    bounds = sorted(set(sample[len(sample) * i // num_ranges] for i in range(1, num_ranges))) if sample else []
+    bounds = [None] + bounds + [None]
+    return [[bounds[i], bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+def mergeRuns(runs):
+    ''' k-way merge of sorted runs (iterables of (key, value) records) into (key, [values])
+    groups in key order, holding one record per run plus the current group in memory '''
+    for key, records in itertools.groupby(heapq.merge(*runs, key=itemgetter(0)), key=itemgetter(0)):
+        yield key, [value for _, value in records]
+
+def shuffleFile(sdfs_prefix, job_id, tid, partition):
+    ''' Worker-local file holding one partition of the output of maple task `tid` of a job '''
+    return os.path.join(TMP_PATH, f"{sdfs_prefix}#j{job_id}#m{tid}#p{partition}")
+
+def spillFile(sdfs_prefix, job_id, tid, partition, spill):
+    ''' Sorted run of one partition of the output of maple task `tid`, spilled while it was running '''
+    return os.path.join(TMP_PATH, f"{sdfs_prefix}#j{job_id}#m{tid}#p{partition}#s{spill}")
+
+def shardName(sdfs_dest_filename, share):
+    ''' SDFS name of the output shard written by the juice task of share number `share` '''
+    return f"{sdfs_dest_filename}.part-{share:05d}"
+
+def exeDigest(data):
+    ''' Content hash an executable is cached under '''
+    return hashlib.sha1(data).hexdigest()
+
+def exeCachePath(digest):
+    return os.path.join(EXE_CACHE_PATH, f"{digest}.py")
+
+def cacheExe(path):
+    ''' Add the executable at `path` to the local cache, returns its digest '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = exeDigest(data)
+    cache_path = exeCachePath(digest)
+    if not os.path.isfile(cache_path):
+        os.makedirs(EXE_CACHE_PATH, exist_ok=True)
+        with open(cache_path + '.part', 'wb') as f:
+            f.write(data)
+        os.replace(cache_path + '.part', cache_path)
+    return digest
+
+def runFile(sdfs_prefix, job_id, tid, source):
+    ''' Worker-local sorted run pulled from one maple worker by juice task `tid` of a job '''
+    return os.path.join(TMP_PATH, f"{sdfs_prefix}#j{job_id}#r{tid}#s{source}")
+
+def stageFile(sdfs_prefix, job_id, tid):
+    ''' Worker-local output of juice task `tid` of a pipeline stage, read by the next stage '''
+    return os.path.join(TMP_PATH, f"{sdfs_prefix}#j{job_id}#o{tid}")
+
+def fetchAllowed(path):
+    ''' Whether a FETCH request may read `path`: only files under the SDFS, tmp and executable
+    cache directories are served, symbolic links and `..` resolved first '''
+    path = os.path.realpath(path)
+    for root in (TMP_PATH, SDFS_PATH, EXE_CACHE_PATH):
+        root = os.path.realpath(os.path.expanduser(root))
+        if os.path.commonpath([path, root]) == root:
+            return True
+    return False
+
+def jobFiles(sdfs_prefix, job_id):
+    ''' Worker-local intermediate files of a job: maple spills and shuffle files, juice runs and
+    pipeline stage output '''
+    prefix = f"{sdfs_prefix}#j{job_id}#"
+    return [os.path.join(TMP_PATH, name) for name in os.listdir(TMP_PATH) if name.startswith(prefix)]
+
+def serveFetch(msg):
+    ''' Answer a bulk channel FETCH request with the requested byte range of a local file,
+    `length` of -1 meaning the rest of the file '''
+    reply = {'type': MessageType.FETCH_REPLY, 'file': msg['file'], 'status': ErrorCode.Normal}
+    if not fetchAllowed(msg['file']):
+        print(f"[ERROR-MJUtils-serveFetch] refused FETCH of {msg['file']} from {msg.get('from_node')}")
+        reply['status'] = ErrorCode.AccessDenied
+        return reply, b''
+    if not os.path.isfile(msg['file']):
+        reply['status'] = ErrorCode.FileNotFound
+        return reply, b''
+    reply['size'] = os.path.getsize(msg['file'])
+    read = readLines if msg.get('lines') else readSplit
+    return reply, read(msg['file'], msg.get('offset', 0), msg.get('length', -1))
+
 class TaskStatus:
     PendingAssign = "pending_assign"
     Assigned = "assigned"
     PendingUpload = "pending_upload"
     PendingCombine = "pending_combine"
     Done = "done"
+    # only in a worker's acknowledgement of an attempt that raised
+    Failed = "failed"
 
 class TaskType:
     Maple = "maple"
@@ -27,20 +299,37 @@ class TaskType:
     TaskCleanup = "task_cleanup"
 
 class Task:
-    def __init__(self, task_type, mj_exe, tid, sdfs_prefix, worker):
+    def __init__(self, task_type, mj_exe, tid, sdfs_prefix, worker, combiner=None, job_id=None):
+        self.job_id = job_id
         self.task_type = task_type
         self.mj_exe = mj_exe
+        self.combiner = combiner
         self.tid = tid
         self.sdfs_prefix = sdfs_prefix
         self.worker = worker
+        # executable name -> content digest
+        self.exes = {}
         self.status = TaskStatus.PendingAssign
         self.data = []
         self.kvpairs = {}
+        # every attempt sent out as [worker, dispatch time], more than one if speculated
+        self.attempts = []
+        self.start_time = None
+        self.end_time = None
+        # times the task was re-run after losing its worker
+        self.retries = 0
+        # attempts that raised on their worker, the job fails after MJ_TASK_MAX_FAILURES of them
+        self.failures = 0
+        # when an attempt last failed on its worker, it isn't re-sent right away
+        self.failed_at = None
     
     def dictify(self):
         dicts = {
+            'job_id': self.job_id,
             'task_type': self.task_type,
             'mj_exe': self.mj_exe,
+            'combiner': self.combiner,
+            'exes': self.exes,
             'tid': self.tid,
             'sdfs_prefix': self.sdfs_prefix,
             'worker': self.worker,
@@ -60,67 +349,370 @@ class JobStatus:
     PendingJuice = "pending_juice"
     RunningJuice = "running_juice"
     Done = "done"
+    # a task kept failing, see Job.error
+    Failed = "failed"
 
 class Job:
-    def __init__(self, mj_exe, num_workers, sdfs_prefix, sdfs_src_file):
+    # optional per-job settings given as `key=value` on the command line
+    OPTIONS = ('combiner', 'split_bytes', 'tasks_per_worker', 'partitions', 'partitioner', 'speculation', 'compress', 'mode', 'shards', 'merge')
+
+    def __init__(self, mj_exe, num_workers, sdfs_prefix, sdfs_src_file, combiner=None, split_bytes=None, tasks_per_worker=None, partitions=None, partitioner=None, speculation=None, compress=None, mode=None, shards=None, merge=None):
+        self.job_id = None
         self.mj_exe = mj_exe
+        self.combiner = combiner
+        self.split_bytes = split_bytes
+        self.tasks_per_worker = tasks_per_worker
+        self.num_partitions = int(partitions or MAPLE_NUM_PARTITIONS)
+        self.partitioner = partitioner
+        # straggler threshold as a multiple of the median task runtime, 0 disables speculation
+        self.speculation = float(MJ_SPECULATIVE_MULTIPLIER if speculation is None else speculation)
+        # zlib-compress the intermediate data on disk and on the wire
+        self.compress = bool(int(compress or 0))
+        # 'script' runs the executables as stdin/stdout programs, 'function' imports them as
+        # modules defining maple(lines) and juice(key, values), see maplejuice_worker.py
+        self.mode = mode or 'script'
+        # juice tasks write their output as shards `<dest>.part-NNNNN` on their workers, stored in
+        # SDFS from there, instead of sending it to the master. `merge` concatenates them into
+        # `<dest>` on the master once the job is done
+        self.shards = bool(int(shards or 0))
+        self.merge = bool(int(merge or 0))
+        # maple tid -> [worker holding its output, bytes written per partition, key sample]
+        self.maple_outputs = {}
+        # input stored in SDFS as {'file', 'size', 'replicas'}, None if it was copied to the master's tmp
+        self.input = None
+        # juice request, kept until the maple phase is done
+        self.juice = None
+        # maple phase settings and tasks, kept during the juice phase in case maple output is lost
+        self.maple = None
+        # juice shares as [partitions, key_range], and the ones whose results are written
+        self.juice_shares = None
+        self.juice_done = []
+        # output shards written so far as [sdfs name, worker, file on the worker]
+        self.output_shards = []
+        # pipeline stages before and after this one, see Pipeline
+        self.upstream = None
+        self.downstream = None
+        # output pieces of the previous stage as [worker, file, size], one maple task each
+        self.stage_inputs = []
+        # executable name -> content digest, for the current phase
+        self.exes = {}
         self.num_workers = int(num_workers)
         self.sdfs_prefix = sdfs_prefix
         self.sdfs_src_file = sdfs_src_file
         self.status = JobStatus.Initialize
+        # why the job failed, if it did
+        self.error = None
         self.workers = []
         self.ready_workers = []
         self.tasks = []
         self.finished_tasks = defaultdict(bool)
+        # one entry per finished task of either phase, see recordTask
+        self.timeline = []
+        self.maple_start_time = None
+        self.maple_end_time = None
+        self.juice_start_time = None
+        self.juice_end_time = None
 
     def dictify(self):
         dicts = {
+            'job_id': self.job_id,
             'status': self.status,
             'num_workers': self.num_workers,
             'sdfs_prefix': self.sdfs_prefix,
             'sdfs_src_file': self.sdfs_src_file,
             'mj_exe': self.mj_exe,
+            'combiner': self.combiner,
+            'exes': self.exes,
+            'split_bytes': self.split_bytes,
+            'tasks_per_worker': self.tasks_per_worker,
+            'partitions': self.num_partitions,
+            'partitioner': self.partitioner,
+            'speculation': self.speculation,
+            'compress': self.compress,
+            'mode': self.mode,
+            'shards': self.shards,
+            'merge': self.merge,
             'workers': self.workers,
             'tasks' : self.tasks,
         }
         return dicts
 
     def assignMapleTask(self, hash_or_range=False):
-        num_lines = 0
+        ''' Cut the input into splits. An SDFS input is split by size alone and each split goes to the
+        least loaded worker holding a replica of the file, until it has its share of the splits and
+        the split goes to a worker that reads it remotely '''
         if DEBUG:
             print(f"DEBUG-MJUtils-assignMapleTask")
-        with open(self.sdfs_src_file, 'r') as f:
-            for _ in f:
-                num_lines += 1
-            f.seek(0)
-
-            tid_counter = 0
-            while (num_lines > 0):
-                for i in range(len(self.workers)):
-                    # make a new task if still need to read lines from src file
-                    task = Task(TaskType.Maple, self.mj_exe, tid_counter, self.sdfs_prefix, self.workers[i])
-                    tid_counter += 1
-                    curr = MAPLE_BLOCK_SIZE
-                    # assign lines to current task
-                    while (curr > 0 and num_lines > 0):
-                        task.data.append(f.readline())
-                        curr -= 1
-                        num_lines -= 1
-                    self.tasks.append(task)
+        self.tasks = []
+        self.finished_tasks = defaultdict(bool)
+
+        if self.input is None:
+            src_file_path = os.path.join(TMP_PATH, self.sdfs_src_file)
+            split_size = splitSize(os.path.getsize(src_file_path), len(self.workers), self.split_bytes, self.tasks_per_worker)
+            splits = planSplits(src_file_path, split_size)
+            replicas = None
+        else:
+            src_file_path = self.input['file']
+            size = self.input['size']
+            split_size = splitSize(size, len(self.workers), self.split_bytes, self.tasks_per_worker)
+            splits = [(offset, min(split_size, size - offset)) for offset in range(0, size, split_size)]
+            replicas = self.input['replicas']
+        if DEBUG:
+            print(f"DEBUG-MJUtils-assignMapleTask {len(splits)} splits of ~{split_size} bytes for {len(self.workers)} workers")
+
+        load = defaultdict(int)
+        share = -(-len(splits) // len(self.workers))
+
+        # only (file, offset, length) descriptors are kept, workers read the bytes themselves
+        for tid, (offset, length) in enumerate(splits):
+            if replicas is None:
+                worker = self.workers[tid % len(self.workers)]
+            else:
+                local = [w for w in self.workers if w in replicas and load[w] < share]
+                worker = min(local or self.workers, key=lambda w: load[w])
+            load[worker] += 1
+
+            task = Task(TaskType.Maple, self.mj_exe, tid, self.sdfs_prefix, worker, self.combiner, self.job_id)
+            task.exes = self.exes
+            task.data = {
+                'file': src_file_path,
+                'offset': offset,
+                'length': length,
+                'partitions': self.num_partitions,
+                'compress': self.compress,
+                'mode': self.mode,
+            }
+            if replicas is not None:
+                # split boundaries are not aligned, the worker reads whole lines around them
+                task.data['replicas'] = replicas
+                task.data['lines'] = True
+            self.tasks.append(task)
     
-    def assignJuiceTask(self, hash_or_range=False):
+    def assignJuiceTask(self, hash_or_range='hash'):
+        ''' Group the intermediate keys into one juice task per worker, either by hash (each task
+        takes every num_workers-th maple partition) or by ranges cut from the maple key samples
+        (each task filters its key range out of all partitions). A task then pulls its share
+        from every maple worker and reduces it in a single worker process. '''
+        self.tasks = []
+        self.finished_tasks = defaultdict(bool)
+        num_tasks = len(self.workers)
+
+        # shares are cut once, a juice phase resumed after a failure only redoes the missing ones
+        if self.juice_shares is None:
+            if hash_or_range == 'range':
+                sample = [k for (_, _, key_sample) in self.maple_outputs.values() for k in key_sample]
+                self.juice_shares = [[list(range(self.num_partitions)), key_range] for key_range in keyRanges(sample, num_tasks)]
+            else:
+                self.juice_shares = [[list(range(i, self.num_partitions, num_tasks)), None] for i in range(min(num_tasks, self.num_partitions))]
+
+        for share, (partitions, key_range) in enumerate(self.juice_shares):
+            if [partitions, key_range] in self.juice_done:
+                continue
+            # worker -> [[maple tid, [its non-empty partitions]]]
+            sources = defaultdict(list)
+            for tid, (host, sizes, _) in self.maple_outputs.items():
+                nonempty = [p for p in partitions if sizes[p] > 0]
+                if nonempty:
+                    sources[host].append([tid, nonempty])
+            if not sources:
+                continue
+
+            tid = len(self.tasks)
+            task = Task(TaskType.Juice, self.mj_exe, tid, self.sdfs_prefix, self.workers[tid % len(self.workers)], job_id=self.job_id)
+            task.exes = self.exes
+            task.data = {
+                'partitions': partitions,
+                'key_range': key_range,
+                'sources': list(sources.items()),
+                'compress': self.compress,
+                'mode': self.mode,
+                # a stage followed by another one keeps its output on the worker
+                'keep_output': self.downstream is not None,
+            }
+            if self.shards and self.downstream is None:
+                # named after the share rather than the task, tasks are renumbered on a resumed juice phase
+                task.data['shard'] = shardName(self.sdfs_src_file, share)
+            self.tasks.append(task)
+
+    def addStageTasks(self):
+        ''' Maple tasks for the output pieces of the previous pipeline stage that came in since the
+        last call, each one scheduled on the worker that wrote the piece. Returns the new tasks '''
+        new = []
+        for host, path, size in self.stage_inputs[len(self.tasks):]:
+            tid = len(self.tasks)
+            worker = host if host in self.workers else self.workers[tid % len(self.workers)]
+            task = Task(TaskType.Maple, self.mj_exe, tid, self.sdfs_prefix, worker, self.combiner, self.job_id)
+            task.exes = self.exes
+            task.data = {
+                'file': path,
+                'offset': 0,
+                'length': size,
+                'partitions': self.num_partitions,
+                'compress': self.compress,
+                'mode': self.mode,
+                'replicas': [host],
+                'lines': True,
+            }
+            self.tasks.append(task)
+            new.append(task)
+        return new
+
+    def stageInputDone(self):
+        ''' Whether all of this job's maple tasks are known: always for a job reading a file, once
+        the previous stage is done and every piece of its output has a task for a pipeline stage '''
+        return self.upstream is None or (self.upstream.status == JobStatus.Done and len(self.tasks) == len(self.stage_inputs))
+
+    def lostStageInput(self, failed_hosts):
+        ''' Whether a piece of the previous stage's output that is still needed was on a failed host '''
+        tasks = self.maple['tasks'] if self.maple is not None else self.tasks
+        for tid, (host, _, _) in enumerate(self.stage_inputs):
+            if host not in failed_hosts:
+                continue
+            output = self.maple_outputs.get(tid)
+            if tid >= len(tasks) or tasks[tid].status != TaskStatus.Done or output is None or output[0] in failed_hosts:
+                return True
+        return False
+
+    def recordTask(self, task, host, stats):
+        ''' Add a finished task to the timeline. `stats` are the worker's own start/finish times
+        (its clock), bytes read and records written; dispatch and ack times are the master's '''
+        self.timeline.append({
+            'phase': task.task_type,
+            'tid': task.tid,
+            'worker': host,
+            'dispatch': next((t for worker, t in task.attempts if worker == host), task.start_time),
+            'start': stats.get('task_start'),
+            'finish': stats.get('task_finish'),
+            'ack': task.end_time,
+            'input_bytes': stats.get('input_bytes'),
+            'output_records': stats.get('output_records'),
+            'attempts': len(task.attempts),
+            'retries': task.retries,
+        })
+
+    def trace(self):
+        ''' The timeline in Chrome trace event format (chrome://tracing or Perfetto), one process
+        per worker with a row per task, the time a task waited to start included '''
+        events = []
+        for phase, start, end in ((TaskType.Maple, self.maple_start_time, self.maple_end_time), (TaskType.Juice, self.juice_start_time, self.juice_end_time)):
+            if start is not None and end is not None:
+                events.append({'name': phase, 'cat': 'phase', 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6, 'pid': 'master', 'tid': phase})
+        for entry in self.timeline:
+            if entry['start'] is None or entry['finish'] is None:
+                continue
+            row = f"{entry['phase']} {entry['tid']}"
+            events.append({'name': 'queued', 'cat': 'wait', 'ph': 'X', 'ts': entry['dispatch'] * 1e6, 'dur': max(0, entry['start'] - entry['dispatch']) * 1e6, 'pid': entry['worker'], 'tid': row})
+            events.append({'name': row, 'cat': entry['phase'], 'ph': 'X', 'ts': entry['start'] * 1e6, 'dur': (entry['finish'] - entry['start']) * 1e6, 'pid': entry['worker'], 'tid': row, 'args': entry})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def resetTask(self, task):
+        ''' Put a task back to be re-run after the worker running it, or holding its output, failed '''
+        task.status = TaskStatus.PendingAssign
+        task.attempts = []
+        task.start_time = None
+        task.end_time = None
+        task.retries += 1
+        self.finished_tasks.pop(task.tid, None)
+        if task.task_type == TaskType.Maple:
+            self.maple_outputs.pop(task.tid, None)
+
+    def resumeMaple(self):
+        ''' Go back from the juice phase to the maple phase, to re-run maple tasks whose output was lost '''
+        self.mj_exe = self.maple['mj_exe']
+        self.exes = self.maple['exes']
+        self.sdfs_src_file = self.maple['sdfs_src_file']
+        self.workers = self.maple['workers']
+        self.tasks = self.maple['tasks']
+        self.finished_tasks = defaultdict(bool, {t.tid: True for t in self.tasks if t.status == TaskStatus.Done})
+        self.status = JobStatus.RunningMaple
+
+    def restart(self):
+        ''' Start the job over from the maple phase, keeping the juice shares already written '''
+        if self.maple is not None:
+            self.mj_exe = self.maple['mj_exe']
+            self.exes = self.maple['exes']
+            self.sdfs_src_file = self.maple['sdfs_src_file']
+            self.maple = None
+        self.status = JobStatus.Initialize
+        self.workers = []
+        self.ready_workers = []
         self.tasks = []
         self.finished_tasks = defaultdict(bool)
+        self.maple_outputs = {}
+
+    def stragglers(self, now):
+        ''' Tasks of the current phase still on their first attempt after running for more than
+        `speculation` times the median runtime of the phase's finished tasks '''
+        if not self.speculation:
+            return []
+        runtimes = [t.end_time - t.start_time for t in self.tasks if t.status == TaskStatus.Done]
+        if not runtimes or len(runtimes) < len(self.tasks) * MJ_SPECULATIVE_MIN_DONE:
+            return []
+        threshold = max(self.speculation * statistics.median(runtimes), MJ_SPECULATIVE_MIN_RUNTIME)
+        return [t for t in self.tasks if t.status == TaskStatus.Assigned and len(t.attempts) == 1 and now - t.start_time > threshold]
+
+    def backupWorker(self, task):
+        ''' The job's least busy worker not already running `task`, None if there is none '''
+        busy = defaultdict(int)
+        for t in self.tasks:
+            if t.status == TaskStatus.Assigned:
+                for worker, _ in t.attempts:
+                    busy[worker] += 1
+        tried = set(worker for worker, _ in task.attempts)
+        candidates = [w for w in self.workers if w not in tried]
+        if not candidates:
+            return None
+        # on a tie, prefer a worker holding the task's input
+        replicas = task.data.get('replicas') or []
+        return min(candidates, key=lambda w: (busy[w], w not in replicas))
+
+class Pipeline:
+    ''' A chain of maple/juice stages submitted as one request. Each stage runs as a Job whose maple
+    tasks read the previous stage's juice output on the workers that wrote it, starting as soon
+    as each piece is written, only the last stage's output goes to `sdfs_dest_filename` '''
+    def __init__(self, stages, num_workers, sdfs_prefix, sdfs_src_file, sdfs_dest_filename, **options):
+        # [maple exe, juice exe, combiner or None] per stage
+        self.stages = [list(stage) for stage in stages]
+        self.num_workers = int(num_workers)
+        self.sdfs_prefix = sdfs_prefix
+        self.sdfs_src_file = sdfs_src_file
+        self.sdfs_dest_filename = sdfs_dest_filename
+        # Job options shared by every stage, each stage has its own combiner
+        self.options = {k: v for k, v in options.items() if k in Job.OPTIONS and k != 'combiner'}
 
-        tid_counter = 0
-        for filename in os.listdir(TMP_PATH):
-            print(filename)
-            print(filename[:len(self.sdfs_prefix)], self.sdfs_prefix)
-            if filename[:len(self.sdfs_prefix)] == self.sdfs_prefix:
-                worker = self.workers[tid_counter % self.num_workers]
-                task = Task(TaskType.Juice, self.mj_exe, tid_counter, self.sdfs_prefix, worker)
-                task.data = filename
-                self.tasks.append(task)
-                tid_counter += 1
+    def exes(self):
+        ''' every executable the stages need '''
+        return sorted(set(exe for stage in self.stages for exe in stage if exe and exe not in COMBINERS))
 
+    def makeJobs(self, exe_digests, sdfs_input):
+        ''' One linked Job per stage, the juice request of each already attached '''
+        jobs = []
+        for maple_exe, juice_exe, combiner in self.stages:
+            job = Job(maple_exe, self.num_workers, self.sdfs_prefix, None, combiner=combiner, **self.options)
+            job.exes = {exe: exe_digests[exe] for exe in (maple_exe, combiner) if exe in exe_digests}
+            job.juice = {
+                'mj_exe': juice_exe,
+                'exes': {juice_exe: exe_digests[juice_exe]},
+                'num_workers': self.num_workers,
+                'sdfs_dest_filename': None,
+                'partitioner': self.options.get('partitioner'),
+                'start_time': None,
+            }
+            if jobs:
+                job.upstream = jobs[-1]
+                jobs[-1].downstream = job
+            jobs.append(job)
+        jobs[0].sdfs_src_file = self.sdfs_src_file
+        jobs[0].input = sdfs_input
+        jobs[-1].juice['sdfs_dest_filename'] = self.sdfs_dest_filename
+        return jobs
 
+    def dictify(self):
+        return {
+            'stages': self.stages,
+            'num_workers': self.num_workers,
+            'sdfs_prefix': self.sdfs_prefix,
+            'sdfs_src_file': self.sdfs_src_file,
+            'sdfs_dest_filename': self.sdfs_dest_filename,
+            'options': self.options,
+        }
@@ -0,0 +1,363 @@
+import io
+import os
+import sys
+import struct
+import threading
+import traceback
+import subprocess
+import importlib.util
+import multiprocessing
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+FRAME_HEADER = struct.Struct('!I')
+# a frame to a worker is a batch of records: argument length, input length, argument, input
+RECORD_HEADER = struct.Struct('!II')
+# A frame to a worker starts with its kind: a BATCH of records answered by one OUTPUTS frame,
+# or a STREAM of one record (after the chunk size) whose output comes back while the executable
+# runs, as CHUNK frames of about that many bytes cut at line ends and then an END frame. If the
+# executable raises, an ERROR frame with its traceback comes instead of the OUTPUTS/END frame
+BATCH = b'B'
+STREAM = b'S'
+OUTPUTS = b'O'
+CHUNK = b'C'
+END = b'E'
+ERROR = b'X'
+STREAM_HEADER = struct.Struct('!I')
+
+def writeFrame(stream, payload):
+    ''' Write one length-prefixed frame to a binary stream '''
+    stream.write(FRAME_HEADER.pack(len(payload)))
+    stream.write(payload)
+    stream.flush()
+
+def readFrame(stream):
+    ''' Read one length-prefixed frame from a binary stream, None on EOF '''
+    header = stream.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    (length,) = FRAME_HEADER.unpack(header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+    return payload
+
+def packBatch(blocks, args=None):
+    ''' Pack input blocks (and an optional argument for each) into one frame payload '''
+    args = args or [''] * len(blocks)
+    parts = []
+    for arg, data in zip(args, blocks):
+        arg = arg.encode()
+        parts.append(RECORD_HEADER.pack(len(arg), len(data)))
+        parts.append(arg)
+        parts.append(data)
+    return b''.join(parts)
+
+def unpackBatch(payload):
+    ''' Inverse of packBatch, returns a list of (argument, input) '''
+    records = []
+    pos = 0
+    while pos < len(payload):
+        arg_len, data_len = RECORD_HEADER.unpack_from(payload, pos)
+        pos += RECORD_HEADER.size
+        arg = payload[pos:pos + arg_len].decode()
+        pos += arg_len
+        records.append((arg, payload[pos:pos + data_len]))
+        pos += data_len
+    return records
+
+def packOutputs(outputs):
+    return b''.join(FRAME_HEADER.pack(len(output)) + output for output in outputs)
+
+def unpackOutputs(payload):
+    outputs = []
+    pos = 0
+    while pos < len(payload):
+        (length,) = FRAME_HEADER.unpack_from(payload, pos)
+        pos += FRAME_HEADER.size
+        outputs.append(payload[pos:pos + length])
+        pos += length
+    return outputs
+
+class ExecutableError(Exception):
+    ''' The user executable raised, the worker running it is still usable '''
+
+class Worker:
+    ''' One long-lived python process with the user executable loaded in it '''
+    def __init__(self, exe):
+        self.exe = exe
+        self.proc = subprocess.Popen(["python3", os.path.abspath(__file__), exe], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def run(self, data):
+        return self.runBatch([data])[0]
+
+    def runBatch(self, blocks, args=None):
+        ''' Run the executable once per block in a single round trip, the i-th block getting
+        args[i] as sys.argv[1] if given. Returns the outputs in order '''
+        writeFrame(self.proc.stdin, BATCH + packBatch(blocks, args))
+        output = readFrame(self.proc.stdout)
+        if output is None:
+            raise BrokenPipeError(f"worker for {self.exe} exited")
+        if output[:1] == ERROR:
+            raise ExecutableError(f"{self.exe} raised:\n{output[1:].decode()}")
+        return unpackOutputs(output[1:])
+
+    def stream(self, data, chunk_bytes):
+        ''' Run the executable on `data`, yielding its output in chunks of whole lines as it prints them '''
+        writeFrame(self.proc.stdin, STREAM + STREAM_HEADER.pack(chunk_bytes) + packBatch([data]))
+        while True:
+            frame = readFrame(self.proc.stdout)
+            if frame is None:
+                raise BrokenPipeError(f"worker for {self.exe} exited")
+            if frame[:1] == END:
+                return
+            if frame[:1] == ERROR:
+                raise ExecutableError(f"{self.exe} raised:\n{frame[1:].decode()}")
+            yield frame[1:]
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+class WorkerPool:
+    ''' Pool of persistent workers for one maple/juice executable. Each call to `run` streams
+    one block of input to an idle worker and returns what the executable printed for it,
+    so the interpreter startup is paid once per worker instead of once per task '''
+    def __init__(self, exe, size=None):
+        self.exe = exe
+        self.size = size or os.cpu_count()
+        self.idle = []
+        self.num_workers = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        ''' an idle worker, a new one if there are fewer than `size`, else wait for one to be released '''
+        with self.cond:
+            while not self.idle and self.num_workers >= self.size:
+                self.cond.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.num_workers += 1
+        try:
+            return Worker(self.exe)
+        except OSError:
+            self.forget()
+            raise
+
+    def release(self, worker):
+        with self.cond:
+            self.idle.append(worker)
+            self.cond.notify()
+
+    def discard(self, worker):
+        ''' kill and reap a worker that died or was given up on, making room for a new one '''
+        worker.proc.kill()
+        worker.proc.wait()
+        self.forget()
+
+    def forget(self):
+        with self.cond:
+            self.num_workers -= 1
+            self.cond.notify()
+
+    def run(self, data):
+        return self.runBatch([data])[0]
+
+    def runBatch(self, blocks, args=None):
+        # a worker that died is replaced and the batch retried once
+        for attempt in range(2):
+            worker = self.acquire()
+            try:
+                outputs = worker.runBatch(blocks, args)
+            except ExecutableError:
+                self.release(worker)
+                raise
+            except (BrokenPipeError, OSError):
+                self.discard(worker)
+                if attempt == 1:
+                    raise
+                continue
+            self.release(worker)
+            return outputs
+
+    def stream(self, data, chunk_bytes):
+        ''' Stream the output of one run of the executable, see Worker.stream. A worker given up
+        on half way through its output is closed rather than put back, and a broken one is not
+        retried since part of its output may already have been consumed '''
+        worker = self.acquire()
+        done = False
+        try:
+            yield from worker.stream(data, chunk_bytes)
+            done = True
+        except ExecutableError:
+            # the run is over, only the executable failed
+            done = True
+            raise
+        finally:
+            if done:
+                self.release(worker)
+            else:
+                self.discard(worker)
+
+    def close(self):
+        with self.cond:
+            while self.idle:
+                self.idle.pop().close()
+            self.num_workers = 0
+
+# Function mode: the executable is a Python module defining maple(lines), returning or yielding
+# (key, value) pairs, and/or juice(key, values), returning the key's result. Every process of a
+# FunctionPool imports it once, data goes back and forth as Python objects instead of text
+MODULE = None
+
+def loadModule(exe):
+    global MODULE
+    spec = importlib.util.spec_from_file_location("mj_exe", exe)
+    MODULE = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(MODULE)
+
+def callMaple(data):
+    ''' maple() on some lines of a split, returns its pairs grouped by key as bytes and their size
+    as `key value` lines. An exception raised by maple() is re-raised by the future's result(),
+    failing the task '''
+    kvpairs = defaultdict(list)
+    size = 0
+    for k, v in MODULE.maple(data.decode().splitlines()):
+        k, v = str(k).encode(), str(v).encode()
+        kvpairs[k].append(v)
+        size += len(k) + len(v) + 2
+    return dict(kvpairs), size
+
+def lineChunks(data, chunk_bytes):
+    ''' Cut `data` into pieces of about `chunk_bytes`, each ending at the end of a line '''
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start + chunk_bytes - 1)
+        end = len(data) if end < 0 else end + 1
+        yield data[start:end]
+        start = end
+
+def callJuice(keys, values):
+    ''' juice() on a batch of keys, values[i] being the list of values of keys[i] '''
+    return [str(MODULE.juice(k, v)) for k, v in zip(keys, values)]
+
+class FunctionPool:
+    ''' ProcessPoolExecutor with the function mode module of one executable loaded in every process.
+    Processes are spawned rather than forked since the datanode is multi-threaded '''
+    def __init__(self, exe, size=None):
+        self.exe = exe
+        self.size = size or os.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=self.size, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=loadModule, initargs=(exe,))
+
+    def maple(self, data, chunk_bytes):
+        ''' Run maple() over pieces of about `chunk_bytes` of the lines of `data`, up to `size` pieces
+        at once, so its output comes back in bounded chunks as with WorkerPool.stream. Yields
+        (pairs grouped by key, their size) in input order '''
+        pending = deque()
+        for piece in lineChunks(data, chunk_bytes):
+            pending.append(self.executor.submit(callMaple, piece))
+            if len(pending) > self.size:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def combine(self, kvpairs):
+        ''' Fold each key's values into the single value juice() returns for them '''
+        keys = list(kvpairs)
+        results = self.executor.submit(callJuice, [k.decode() for k in keys], [[v.decode() for v in kvpairs[k]] for k in keys]).result()
+        return {k: [result.encode()] for k, result in zip(keys, results)}
+
+    def juiceBatches(self, batches):
+        ''' Run juice() over (keys, values) batches, up to `size` batches at once so one juice task
+        uses every core. Yields (keys, results) in batch order '''
+        pending = deque()
+        for keys, values in batches:
+            pending.append((keys, self.executor.submit(callJuice, keys, values)))
+            if len(pending) > self.size:
+                keys, future = pending.popleft()
+                yield keys, future.result()
+        while pending:
+            keys, future = pending.popleft()
+            yield keys, future.result()
+
+    def close(self):
+        self.executor.shutdown()
+
+class ChunkWriter(io.TextIOBase):
+    ''' sys.stdout of a streamed run: sends what the executable prints as CHUNK frames once about
+    `chunk_bytes` of it are buffered, up to the last complete line. getvalue() returns the rest '''
+    def __init__(self, stream, chunk_bytes):
+        self.stream = stream
+        self.chunk_bytes = chunk_bytes
+        self.parts = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        self.parts.append(s)
+        self.size += len(s)
+        if self.size >= self.chunk_bytes:
+            buffered = ''.join(self.parts)
+            end = buffered.rfind('\n') + 1
+            if end:
+                writeFrame(self.stream, CHUNK + buffered[:end].encode())
+            self.parts = [buffered[end:]]
+            self.size = len(self.parts[0])
+        return len(s)
+
+    def getvalue(self):
+        rest = ''.join(self.parts)
+        self.parts, self.size = [], 0
+        return rest
+
+def runOnce(code, exe, arg, data, stdout=None):
+    ''' Run the compiled executable with sys.stdin / sys.stdout redirected to `data` / the result,
+    or to `stdout` if given, in which case only what it hasn't sent yet is returned. Exceptions
+    raised by the executable are left to the caller '''
+    sys.argv = [exe, arg] if arg else [exe]
+    sys.stdin = io.TextIOWrapper(io.BytesIO(data))
+    sys.stdout = stdout or io.StringIO()
+    try:
+        exec(code, {'__name__': '__main__', '__file__': exe})
+    except SystemExit:
+        pass
+    finally:
+        output = sys.stdout.getvalue()
+        sys.stdin = sys.__stdin__
+        sys.stdout = sys.__stdout__
+    return output.encode()
+
+def serve(exe):
+    ''' Worker side: compile `exe` once, then run it on every record of every batch received
+    on stdin and answer each batch with one frame of outputs '''
+    with open(exe, 'r') as f:
+        code = compile(f.read(), exe, 'exec')
+
+    frames_in = sys.stdin.buffer
+    frames_out = sys.stdout.buffer
+
+    while True:
+        frame = readFrame(frames_in)
+        if frame is None:
+            break
+        # the executable's output goes into its task, a traceback mustn't: it is sent as an ERROR
+        # frame and fails the task
+        try:
+            if frame[:1] == STREAM:
+                (chunk_bytes,) = STREAM_HEADER.unpack_from(frame, 1)
+                [(arg, data)] = unpackBatch(frame[1 + STREAM_HEADER.size:])
+                rest = runOnce(code, exe, arg, data, ChunkWriter(frames_out, chunk_bytes))
+                if rest:
+                    writeFrame(frames_out, CHUNK + rest)
+                writeFrame(frames_out, END)
+            else:
+                outputs = [runOnce(code, exe, arg, data) for arg, data in unpackBatch(frame[1:])]
+                writeFrame(frames_out, OUTPUTS + packOutputs(outputs))
+        except Exception:
+            writeFrame(frames_out, ERROR + traceback.format_exc().encode())
+
+if __name__ == '__main__':
+    serve(sys.argv[1])
@@ -14,21 +14,22 @@ from membership_utils import (
 )
 
 from constants import (
-    DEFAULT_PORT_MEMBERSHIP,
+    NODE_ID,
     ALL_HOST_NAMES,
     INTRODUCER_HOST_NAMES,
+    nodeAddr,
 )
 
 from message import MessageType, Message
 
 GOSSIP_RATE = 1
-ALL_ADDRESSES = [(host_name, DEFAULT_PORT_MEMBERSHIP) for host_name in ALL_HOST_NAMES]
-INTRODUCER_ADDRESSES = [(host_name, DEFAULT_PORT_MEMBERSHIP) for host_name in INTRODUCER_HOST_NAMES]
+ALL_ADDRESSES = [nodeAddr(node) for node in ALL_HOST_NAMES]
+INTRODUCER_ADDRESSES = [nodeAddr(node) for node in INTRODUCER_HOST_NAMES]
 
 class MembershipServer:
     def __init__(self, 
-                host = socket.gethostname(), 
-                port = DEFAULT_PORT_MEMBERSHIP, 
+                host = nodeAddr(NODE_ID)[0], 
+                port = nodeAddr(NODE_ID)[1], 
                 mode = "gossip"):
         self.id = str(uuid.uuid4())
         self.ip_address = (host, port)
@@ -22,11 +22,17 @@ class MessageType:
     # Mapreduce Client messages
     MAPLE = 'maple'
     JUICE = 'juice'
+    PIPELINE = 'pipeline'
     # Mapreduce DataNode messages
     JOB = 'job'
     TASK = 'task'
     JOB_ACK = 'job_ack'
     TASK_ACK = 'task_ack'
+    JOB_CLEANUP = 'job_cleanup'
+    # Mapreduce bulk channel messages
+    FETCH = 'fetch'
+    FETCH_PARTITION = 'fetch_partition'
+    FETCH_REPLY = 'fetch_reply'
 
 class Message:
     def __init__(self, body, type=MessageType.ML):
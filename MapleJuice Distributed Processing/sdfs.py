@@ -8,6 +8,7 @@ from sdfs_namenode import NameNodeServer
 from sdfs_datanode import DataNodeServer
 from membership import MembershipServer
 from message import MessageType
+from constants import DATA_DIR
 
 class SDFSServer:
     def __init__(self):
@@ -60,5 +61,8 @@ class SDFSServer:
         self.listener()
 
 if __name__ == '__main__':
+    # every node works in its own data directory, see cluster_config.py
+    os.makedirs(DATA_DIR, exist_ok=True)
+    os.chdir(DATA_DIR)
     s = SDFSServer()
     s.run()
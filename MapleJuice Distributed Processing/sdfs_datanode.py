@@ -5,10 +5,9 @@ import time
 import socket
 import subprocess
 import threading
-from paramiko import SSHClient
-from scp import SCPClient
 
 from logger import Logger
+from ssh_pool import SSH_POOL
 
 from sdfs_utils import (
     SDFSFile,
@@ -17,13 +16,13 @@ from sdfs_utils import (
 )
 
 from constants import (
+    NODE_ID,
     DEFAULT_PORT_SDFS_DATANODE,
     SDFS_PATH,
-)
-
-from credentials import (
-    USERNAME,
-    PASSWORD,
+    SSH_RETRY_DELAY,
+    nodeAddr,
+    nodeHost,
+    nodeDataDir,
 )
 
 from message import (
@@ -35,8 +34,8 @@ DEBUG = True
 
 class DataNodeServer:
     def __init__(self):
-        self.host = socket.gethostname()
-        self.addr = (self.host, DEFAULT_PORT_SDFS_DATANODE)
+        self.host = NODE_ID
+        self.addr = nodeAddr(self.host, DEFAULT_PORT_SDFS_DATANODE)
         self.logger = Logger(name="DataNodeServer").logger
 
     def handleUploadRequest(self, message):
@@ -97,18 +96,11 @@ class DataNodeServer:
         if self.host in replica_hosts:
             shutil.copyfile(sdfs_filepath, filename)
         else:
-            ssh = SSHClient()
-            ssh.load_system_host_keys()
-            ssh.connect(hostname = replica_hosts[0],
-                        username = USERNAME,
-                        password = PASSWORD)
-
             while filename not in os.listdir('.'):
                 try:
-                    with SCPClient(ssh.get_transport()) as scp:
-                        scp.get(sdfs_filepath, filename)
+                    SSH_POOL.get(nodeHost(replica_hosts[0]), self.remotePath(replica_hosts[0], sdfs_filepath), filename)
                 except:
-                    pass
+                    time.sleep(SSH_RETRY_DELAY)
 
         filename_size = os.path.getsize(filename)
         print(f"[INFO-DataNode-handleGet] [{sdfs_filename}] successfully saved as [{filename}] of size [{filename_size}]")
@@ -123,22 +115,19 @@ class DataNodeServer:
         sdfs_filename = message['sdfsname']
         sdfs_filepath = os.path.join(SDFS_PATH, sdfs_filename)
 
-        ssh = SSHClient()
-        ssh.load_system_host_keys()
-        ssh.connect(hostname = replica_hosts[0],
-                    username = USERNAME,
-                    password = PASSWORD)
-
         while sdfs_filename not in os.listdir(os.path.expanduser(SDFS_PATH)):
             try:
-                with SCPClient(ssh.get_transport()) as scp:
-                    scp.get(sdfs_filepath, sdfs_filepath)
+                SSH_POOL.get(nodeHost(replica_hosts[0]), self.remotePath(replica_hosts[0], sdfs_filepath), sdfs_filepath)
             except:
-                pass
+                time.sleep(SSH_RETRY_DELAY)
 
         self.sendAcknowledgement(message, MessageType.REP_ACK)
         return ErrorCode.Normal
 
+    def remotePath(self, node, sdfs_filepath):
+        ''' path of our `sdfs_filepath` on `node`, whose data directory may differ from ours '''
+        return os.path.join(nodeDataDir(node), sdfs_filepath)
+
     def sendAcknowledgement(self, message, msg_type):
         if DEBUG:
             print(f"[DEBUG-DataNode-sendAck] sent a ACK {msg_type} to master {message['from_vm']}")
@@ -147,6 +136,7 @@ class DataNodeServer:
             dicts = {
                 'filename': message['filename'],
                 'from_vm': self.addr,
+                'from_node': self.host,
                 'type': msg_type
                 }
             data = json.dumps(dicts).encode('UTF-8')
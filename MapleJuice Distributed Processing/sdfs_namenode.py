@@ -16,10 +16,13 @@ from sdfs_utils import (
 )
 
 from constants import (
+    NODE_ID,
     DEFAULT_PORT_SDFS_NAMENODE,
     DEFAULT_PORT_SDFS_DATANODE,
     DEFAULT_PRIMARY_NAMENODE_HOST,
-    DEFAULT_BACKUP_NAMENODE_HOSTS
+    DEFAULT_BACKUP_NAMENODE_HOSTS,
+    nodeAddr,
+    nodeId,
 )
 
 from message import (
@@ -31,12 +34,12 @@ DEBUG = True
 
 class NameNodeServer:
     def __init__(self, mem_server):
-        self.host = socket.gethostname()
-        self.addr = (self.host, DEFAULT_PORT_SDFS_NAMENODE)
+        self.host = NODE_ID
+        self.addr = nodeAddr(self.host, DEFAULT_PORT_SDFS_NAMENODE)
         
         self.primary = False
         self.masterHost = DEFAULT_PRIMARY_NAMENODE_HOST
-        self.masterAddr = (self.masterHost, DEFAULT_PORT_SDFS_NAMENODE)
+        self.masterAddr = nodeAddr(self.masterHost, DEFAULT_PORT_SDFS_NAMENODE)
 
         self.membershipList = mem_server
         self.fileTable = defaultdict(SDFSFile)
@@ -228,23 +231,25 @@ class NameNodeServer:
                     temp_file_table[f] = self.fileTable[f].dictify()
                 dicts['type'] = MessageType.FILE_TABLE
                 dicts['from_vm'] = self.addr
+                dicts['from_node'] = self.host
                 dicts['file_table'] = temp_file_table
                 data = json.dumps(dicts).encode('UTF-8')
 
                 for vm in active_vms:
-                    to_vm = (vm, DEFAULT_PORT_SDFS_NAMENODE)
+                    to_vm = nodeAddr(vm, DEFAULT_PORT_SDFS_NAMENODE)
                     sock.sendto(data, to_vm)
 
 
     def sendInstruction(self, host, sdfsFile, msg_type, port = DEFAULT_PORT_SDFS_DATANODE):
         ''' send instruction to the target host '''
-        to_vm = (host, port)
+        to_vm = nodeAddr(host, port)
         if DEBUG:
             print(f"[DEBUG-NameNode-sendInstr] send message {msg_type} to address: {to_vm}")
 
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
             dicts = sdfsFile.dictify()
             dicts['from_vm'] = self.addr
+            dicts['from_node'] = self.host
             dicts['type'] = msg_type
             data = json.dumps(dicts).encode('UTF-8')
 
@@ -260,13 +265,13 @@ class NameNodeServer:
             time.sleep(1)
             ml = self.membershipList.mem_list
             with ml.lock:
-                cur_active_hosts = [x.address[0] for x in ml.list.values()]
+                cur_active_hosts = [nodeId(x.address) for x in ml.list.values()]
                 
             with self.lock:
                 # Get newest host
                 if len(cur_active_hosts) >= 4 and self.masterHost not in cur_active_hosts:
                     self.masterHost = min(cur_active_hosts)
-                    self.masterAddr = (self.masterHost, DEFAULT_PORT_SDFS_NAMENODE)
+                    self.masterAddr = nodeAddr(self.masterHost, DEFAULT_PORT_SDFS_NAMENODE)
 
                 # Check if self is the primary master
                 self.primary = True if (self.masterAddr == self.addr) else False
@@ -292,7 +297,7 @@ class NameNodeServer:
         while True:
             data, _ = sock.recvfrom(8192)
             msg = json.loads(data.decode('UTF-8'))
-            host = msg['from_vm'][0]
+            host = msg['from_node']
 
             if DEBUG:
                 print(f"[DEBUG-NameNode-receiver] received message from {msg['from_vm']} of type {msg['type']}")
@@ -6,6 +6,7 @@ class ErrorCode:
     FileNotFound = "file not found"
     FileNotReady = "file not ready"
     NotEnoughNodes = "not enough nodes"
+    AccessDenied = "access denied"
 
 class FileStatus:
     # fileStatus: pendingUpload, pendingReplication, ready, pendingDelete, deleted, pendingChange
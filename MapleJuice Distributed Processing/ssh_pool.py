@@ -0,0 +1,107 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from paramiko import SSHClient, SSHException
+from scp import SCPClient
+
+from credentials import (
+    USERNAME,
+    PASSWORD,
+)
+
+from constants import (
+    SSH_POOL_SIZE,
+    SSH_KEEPALIVE,
+)
+
+DEBUG = False
+
+class SSHPool:
+    ''' Authenticated SSH sessions kept open per host and reused for every SCP transfer, so the
+    handshake is paid once per host. At most `size` sessions are open at once: beyond that an
+    idle session to another host is closed, or the caller waits for one to be returned '''
+    def __init__(self, size=SSH_POOL_SIZE, keepalive=SSH_KEEPALIVE):
+        self.size = size
+        self.keepalive = keepalive
+        # host -> idle sessions
+        self.idle = defaultdict(list)
+        self.num_open = 0
+        self.cond = threading.Condition()
+
+    def connect(self, host):
+        ssh = SSHClient()
+        ssh.load_system_host_keys()
+        ssh.connect(hostname = host,
+                    username = USERNAME,
+                    password = PASSWORD)
+        ssh.get_transport().set_keepalive(self.keepalive)
+        if DEBUG:
+            print(f"[DEBUG-SSHPool-connect] new session to {host}, {self.num_open} open")
+        return ssh
+
+    def closeIdle(self, host):
+        ''' close one idle session to `host` (called with cond held) '''
+        self.idle[host].pop(0).close()
+        self.num_open -= 1
+
+    def acquire(self, host):
+        with self.cond:
+            while True:
+                while self.idle[host]:
+                    ssh = self.idle[host].pop()
+                    transport = ssh.get_transport()
+                    if transport is not None and transport.is_active():
+                        return ssh
+                    ssh.close()
+                    self.num_open -= 1
+                if self.num_open < self.size:
+                    self.num_open += 1
+                    break
+                other = next((h for h, sessions in self.idle.items() if sessions), None)
+                if other is not None:
+                    self.closeIdle(other)
+                else:
+                    self.cond.wait()
+
+        try:
+            return self.connect(host)
+        except Exception:
+            with self.cond:
+                self.num_open -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, host, ssh, broken=False):
+        with self.cond:
+            if broken:
+                ssh.close()
+                self.num_open -= 1
+            else:
+                self.idle[host].append(ssh)
+            self.cond.notify()
+
+    @contextmanager
+    def session(self, host):
+        ''' a pooled SSHClient connected to `host`. It is dropped instead of reused only if the caller
+        fails on the connection itself; other errors (e.g. an SCP "file not found") keep it pooled '''
+        ssh = self.acquire(host)
+        try:
+            yield ssh
+        except (SSHException, OSError) as e:
+            transport = ssh.get_transport()
+            broken = isinstance(e, SSHException) or transport is None or not transport.is_active()
+            self.release(host, ssh, broken=broken)
+            raise
+        except BaseException:
+            self.release(host, ssh)
+            raise
+        self.release(host, ssh)
+
+    def get(self, host, remote_path, local_path):
+        ''' SCP `remote_path` on `host` to `local_path` over a pooled session '''
+        with self.session(host) as ssh:
+            with SCPClient(ssh.get_transport()) as scp:
+                scp.get(remote_path, local_path)
+
+# shared by every SCP call site of the process (SDFS and MapleJuice servers)
+SSH_POOL = SSHPool()